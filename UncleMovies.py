@@ -1,5 +1,9 @@
+import time
+
+# Startup is timed from here (see end_startup_phase)
+startup_started = time.perf_counter()
+
 import re
-import openai
 import discord
 import os
 from discord import app_commands
@@ -8,6 +12,59 @@ from dotenv import load_dotenv
 import asyncio
 import json
 import uuid
+import atexit
+import threading
+import sqlite3
+import bisect
+import array
+import random
+import gc
+import struct
+import zlib
+import mmap
+import itertools
+import gzip
+import sys
+import importlib.util
+import traceback
+from collections import OrderedDict, deque, Counter
+from contextlib import contextmanager
+from aiohttp import web
+
+# Startup phase -> seconds it took, in order (logged once the bot is ready)
+startup_phases = OrderedDict()
+last_startup_mark = startup_started
+
+# This function is used to record how long a startup phase took (since the end of the previous one)
+
+
+def end_startup_phase(name):
+    global last_startup_mark
+    now = time.perf_counter()
+    startup_phases[name] = now - last_startup_mark
+    last_startup_mark = now
+
+
+end_startup_phase("imports")
+
+# This function is used to import a module only when one of its attributes is first used.
+# The openai package is slow to import and is not needed until a movie is looked up
+
+
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+openai = lazy_import("openai")
 
 # Load environment variables from .env file
 # test
@@ -16,31 +73,1768 @@ try:
 except FileNotFoundError:
     print("Could not find .env file")
 
+# Setting the key does not import openai yet (the lazy module keeps it for when it is imported)
 openai.api_key = os.getenv("API_KEY")
 
-if openai.api_key is None:
+if os.getenv("API_KEY") is None:
     print("API key not set. Set the API key using openai.api_key = 'YOUR_API_KEY'")
 else:
     print("Connected to OpenAI API key...")
 
+# The catalog is loaded in on_ready, and commands wait until it is (see start_up)
+catalog_ready = asyncio.Event()
+# Why the catalog could not be loaded, or None. Commands reply with it instead of waiting forever
+catalog_error = None
+
+# This class is used to make slash commands (and their autocomplete) wait until the catalog is loaded
+
+
+class MovieCommandTree(app_commands.CommandTree):
+    async def interaction_check(self, interaction):
+        await catalog_ready.wait()
+        if catalog_error is None:
+            # Slash commands are timed from here, like > commands are from before_invoke
+            interaction.extras["command_started"] = time.perf_counter()
+            return True
+        # Autocomplete cannot be answered with a message
+        if interaction.type != discord.InteractionType.autocomplete:
+            await interaction.response.send_message(catalog_error, ephemeral=True)
+        return False
+
+    async def on_error(self, interaction, error):
+        stop_app_command_timer(interaction)
+        await super().on_error(interaction, error)
+
+
 # Create a bot object using the commands module
-bot = commands.Bot(command_prefix=">", intents=discord.Intents.all())
+bot = commands.Bot(command_prefix=">", intents=discord.Intents.all(), tree_cls=MovieCommandTree)
 
-# This function is used to get the list of movies from the logger (by reading from the movie-log.txt file)
 
+# This class is used to refuse > commands when the catalog could not be loaded
 
-def get_movie_list():
-    try:
-        with open("movies.json", "r") as json_file:
-            data = json.load(json_file)
-    except FileNotFoundError:
-        return "movies.json file not found"
+
+class CatalogUnavailable(commands.CheckFailure):
+    pass
+
+
+# Make > commands wait until the catalog is loaded
+
+
+@bot.check
+async def wait_for_catalog(ctx):
+    await catalog_ready.wait()
+    if catalog_error is not None:
+        raise CatalogUnavailable(catalog_error)
+    return True
+
+
+# The fields that can be searched and the fields that can be sorted
+SEARCH_FIELDS = ["movie_name", "year", "director", "description", "genre"]
+SORT_FIELDS = ["movie_name", "year", "genre", "director", "added"]
+
+# This function is used to fold text so searches and name lookups are case-insensitive
+
+
+def fold(text):
+    return text.lower()
+
+
+# This function is used to get the text of a movie field (the genre list is joined with commas)
+
+
+def field_text(movie, field):
+    value = getattr(movie, field)
+    if isinstance(value, list):
+        return ", ".join(value)
+    return value
+
+
+# Genre -> number that stands for it in the movies, and the genres in the order of their numbers.
+# Tuples of genre numbers are shared too, so movies with the same genres keep one tuple
+genre_numbers = {}
+genre_names = []
+genre_tuples = {}
+genre_lock = threading.Lock()
+
+# This function is used to turn a list of genres into the shared tuple of their numbers
+
+
+def encode_genres(genres):
+    numbers = []
+    for genre in genres:
+        number = genre_numbers.get(genre)
+        if number is None:
+            with genre_lock:
+                number = genre_numbers.get(genre)
+                if number is None:
+                    number = genre_numbers[genre] = len(genre_names)
+                    genre_names.append(sys.intern(genre))
+        numbers.append(number)
+    numbers = tuple(numbers)
+    return genre_tuples.setdefault(numbers, numbers)
+
+
+# This class is used to keep one movie of the catalog. It has __slots__ instead of a __dict__, the
+# year and director strings are shared between movies (sys.intern) and the genres are kept as a
+# tuple of genre numbers. The description can also be left in the binary snapshot on disk (see
+# SnapshotText) and read only when it is used
+
+
+class Movie:
+    __slots__ = ("id", "movie_name", "_year", "_director", "_genres", "_description", "_snapshot")
+
+    def __init__(self, id, movie_name, year="", director="", description="", genre=(), snapshot=None):
+        self.id = id
+        self.movie_name = movie_name
+        self.year = year
+        self.director = director
+        self.genre = genre
+        # With a snapshot, description is the number of the string in it
+        self._description = description
+        self._snapshot = snapshot
+
+    # This function is used to make a movie from its JSON form (as in movies.json and the journal)
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["id"], data["movie_name"], data.get("year", ""), data.get("director", ""),
+                   data.get("description", ""), data.get("genre", ()))
+
+    # This function is used to get the JSON form of the movie
+    def to_dict(self):
+        return {"id": self.id, "movie_name": self.movie_name, "year": self.year, "director": self.director,
+                "description": self.description, "genre": self.genre}
+
+    @property
+    def year(self):
+        return self._year
+
+    @year.setter
+    def year(self, year):
+        self._year = sys.intern(year)
+
+    @property
+    def director(self):
+        return self._director
+
+    @director.setter
+    def director(self, director):
+        self._director = sys.intern(director)
+
+    @property
+    def genre(self):
+        return [genre_names[number] for number in self._genres]
+
+    @genre.setter
+    def genre(self, genres):
+        self._genres = encode_genres(genres)
+
+    @property
+    def description(self):
+        if self._snapshot is not None:
+            return self._snapshot.text(self._description)
+        return self._description
+
+    @description.setter
+    def description(self, description):
+        self._description = description
+        self._snapshot = None
+
+    def __repr__(self):
+        return f"Movie({self.id!r}, {self.movie_name!r})"
+
+
+# This class is used to count how long something took in fixed latency buckets (like a Prometheus
+# histogram), so percentiles can be estimated without keeping every sample
+
+
+class LatencyHistogram:
+    # Upper bounds of the buckets in seconds (the last bucket has no upper bound)
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        # Interpolate inside the bucket the quantile falls in (like histogram_quantile in Prometheus)
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.BUCKETS[i - 1] if i > 0 else 0.0
+                upper = self.BUCKETS[i] if i < len(self.BUCKETS) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / count, self.max)
+            seen += count
+        return self.max
+
+
+# This class is used to keep the latency histograms of the bot: one per command, and one per
+# kind of work the commands do (store I/O, index lookups and OpenAI calls)
+
+
+class Metrics:
+    # Kind of timer -> (Prometheus metric name, label name, help text)
+    KINDS = {
+        "command": ("unclemovies_command_seconds", "command", "Time to run a bot command"),
+        "store": ("unclemovies_store_seconds", "operation", "Time spent reading and writing the movie store"),
+        "index": ("unclemovies_index_seconds", "lookup", "Time spent looking movies up in the indexes"),
+        "openai": ("unclemovies_openai_seconds", "stage", "Time spent on OpenAI requests"),
+        "loop": ("unclemovies_loop_lag_seconds", "monitor", "Delay of the event loop in running a scheduled callback"),
+    }
+
+    def __init__(self):
+        # (kind, name) -> histogram
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, kind, name, seconds):
+        with self._lock:
+            histogram = self.histograms.get((kind, name))
+            if histogram is None:
+                histogram = self.histograms[(kind, name)] = LatencyHistogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def time(self, kind, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(kind, name, time.perf_counter() - started)
+
+    # Returns the histograms in the Prometheus text format
+    def prometheus(self):
+        lines = []
+        with self._lock:
+            for kind, (metric, label, help_text) in self.KINDS.items():
+                histograms = sorted((name, histogram) for (histogram_kind, name), histogram in self.histograms.items()
+                                    if histogram_kind == kind)
+                if not histograms:
+                    continue
+                lines.append(f"# HELP {metric} {help_text}")
+                lines.append(f"# TYPE {metric} histogram")
+                for name, histogram in histograms:
+                    cumulative = 0
+                    for bound, count in zip(histogram.BUCKETS + ("+Inf",), histogram.counts):
+                        cumulative += count
+                        lines.append(f'{metric}_bucket{{{label}="{name}",le="{bound}"}} {cumulative}')
+                    lines.append(f'{metric}_sum{{{label}="{name}"}} {histogram.sum}')
+                    lines.append(f'{metric}_count{{{label}="{name}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+    # Returns a table of the percentiles of every histogram, in milliseconds
+    def summary(self):
+        lines = [f"{'timer':<28}{'count':>7}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}"]
+        with self._lock:
+            for (kind, name), histogram in sorted(self.histograms.items()):
+                lines.append(f"{kind + ':' + name:<28}{histogram.count:>7}" + "".join(
+                    f"{value * 1000:>9.1f}" for value in (histogram.quantile(0.5), histogram.quantile(0.95),
+                                                          histogram.quantile(0.99), histogram.max)))
+        return "\n".join(lines)
+
+
+metrics = Metrics()
+
+# This class is used to keep an inverted index from the words of movie fields to movie IDs.
+# A search only looks at the postings of the words in the query instead of scanning every movie
+
+
+class TokenIndex:
+    TOKEN_PATTERN = re.compile(r"\w+")
+
+    def __init__(self, fields):
+        self.fields = fields
+        # For each field: word -> set of movie IDs
+        self.postings = {field: {} for field in fields}
+        # For each field: sorted words and sorted reversed words (for prefix and suffix lookups)
+        self.words = {field: [] for field in fields}
+        self.reversed_words = {field: [] for field in fields}
+
+    def _tokens(self, movie, field):
+        return set(self.TOKEN_PATTERN.findall(fold(field_text(movie, field))))
+
+    def build(self, movies):
+        # Index many movies at once, sorting the word lists only once at the end
+        self.extend(movies)
+        self.sort_words()
+
+    # Adds movies to the postings only. The sorted word lists are out of date until sort_words is
+    # called, so candidates must not be used in between
+    def extend(self, movies):
+        for field in self.fields:
+            postings = self.postings[field]
+            for movie in movies:
+                for token in self._tokens(movie, field):
+                    postings.setdefault(token, set()).add(movie.id)
+
+    def sort_words(self):
+        for field in self.fields:
+            self.words[field] = sorted(self.postings[field])
+            self.reversed_words[field] = sorted(word[::-1] for word in self.postings[field])
+
+    def add(self, movie):
+        for field in self.fields:
+            postings = self.postings[field]
+            for token in self._tokens(movie, field):
+                if token not in postings:
+                    postings[token] = set()
+                    bisect.insort(self.words[field], token)
+                    bisect.insort(self.reversed_words[field], token[::-1])
+                postings[token].add(movie.id)
+
+    def discard(self, movie):
+        for field in self.fields:
+            postings = self.postings[field]
+            for token in self._tokens(movie, field):
+                movie_ids = postings.get(token)
+                if movie_ids is None:
+                    continue
+                movie_ids.discard(movie.id)
+                if not movie_ids:
+                    del postings[token]
+                    self._remove_sorted(self.words[field], token)
+                    self._remove_sorted(self.reversed_words[field], token[::-1])
+
+    def _remove_sorted(self, words, word):
+        i = bisect.bisect_left(words, word)
+        if i < len(words) and words[i] == word:
+            del words[i]
+
+    def _with_prefix(self, words, prefix):
+        i = bisect.bisect_left(words, prefix)
+        while i < len(words) and words[i].startswith(prefix):
+            yield words[i]
+            i += 1
+
+    def candidates(self, field, query):
+        # Returns the IDs of the movies that can contain the (folded) query, or None if the
+        # query has no words and every movie has to be checked
+        matches = list(self.TOKEN_PATTERN.finditer(query))
+        if not matches:
+            return None
+        postings = self.postings[field]
+        result = None
+        for match in matches:
+            token = match.group()
+            # A word in the middle of the query must be a whole word of the field, while the
+            # first and last words of the query can be the end or start of a longer word
+            open_start = match.start() == 0
+            open_end = match.end() == len(query)
+            if open_start and open_end:
+                words = [word for word in postings if token in word]
+            elif open_start:
+                words = [word[::-1] for word in self._with_prefix(self.reversed_words[field], token[::-1])]
+            elif open_end:
+                words = self._with_prefix(self.words[field], token)
+            else:
+                words = [token] if token in postings else []
+            movie_ids = set()
+            for word in words:
+                movie_ids.update(postings[word])
+            result = movie_ids if result is None else result & movie_ids
+            if not result:
+                break
+        return result
+
+
+# This class is used to keep an index from the 3-character pieces (trigrams) of movie fields to
+# movies. Any text containing the query contains all of the query's trigrams, so only movies
+# that share every trigram have to be checked, and partial-word searches stay fast
+
+
+class TrigramIndex:
+    def __init__(self, fields):
+        self.fields = fields
+        self.build([])
+
+    def _trigrams(self, text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def build(self, movies):
+        # For each field: trigram -> sorted array of movie numbers. Every indexed movie gets a new,
+        # higher number, so the arrays stay sorted by just appending to them
+        self.postings = {field: {} for field in self.fields}
+        self._numbers = {}
+        self._movies = {}
+        self._next_number = 0
+        # Numbers of removed movies that are still in the postings
+        self._stale = 0
+        for movie in movies:
+            self.add(movie)
+
+    def add(self, movie):
+        number = self._next_number
+        self._next_number += 1
+        self._numbers[movie.id] = number
+        self._movies[number] = movie
+        for field in self.fields:
+            postings = self.postings[field]
+            for trigram in self._trigrams(fold(getattr(movie, field))):
+                numbers = postings.get(trigram)
+                if numbers is None:
+                    numbers = postings[trigram] = array.array("I")
+                numbers.append(number)
+
+    def discard(self, movie):
+        # The movie's number is left in the postings and skipped by searches until there are
+        # more removed numbers than movies, then the whole index is rebuilt
+        number = self._numbers.pop(movie.id, None)
+        if number is None:
+            return
+        del self._movies[number]
+        self._stale += 1
+        if self._stale > max(len(self._movies), 1000):
+            self.build(list(self._movies.values()))
+
+    def candidates(self, field, query, max_candidates=None):
+        # Returns the IDs of the movies that can contain the (folded) query, or None if the
+        # query is too short to have a trigram or even its rarest trigram is in more than
+        # max_candidates movies
+        if len(query) < 3:
+            return None
+        postings = self.postings[field]
+        trigram_postings = [postings.get(trigram) for trigram in self._trigrams(query)]
+        if None in trigram_postings:
+            return set()
+        # Start from the smallest postings and intersect them with the others. A few remaining numbers
+        # are looked up with bisect, otherwise the set intersection (in C) is faster
+        trigram_postings.sort(key=len)
+        if max_candidates is not None and len(trigram_postings[0]) > max_candidates:
+            return None
+        numbers = set(trigram_postings[0])
+        for other in trigram_postings[1:]:
+            if not numbers:
+                break
+            if len(numbers) * 16 < len(other):
+                numbers = {number for number in numbers if self._contains(other, number)}
+            else:
+                numbers.intersection_update(other)
+        return {self._movies[number].id for number in numbers if number in self._movies}
+
+    def _contains(self, numbers, number):
+        i = bisect.bisect_left(numbers, number)
+        return i < len(numbers) and numbers[i] == number
+
+
+# Roman numerals that are written as numbers when titles are compared ("Part II" -> "Part 2")
+ROMAN_NUMERALS = {"ii": "2", "iii": "3", "iv": "4", "v": "5", "vi": "6", "vii": "7", "viii": "8", "ix": "9", "x": "10"}
+
+# This function is used to normalize a movie title before it is compared with other titles
+
+
+def normalize_title(movie_name):
+    words = re.findall(r"\w+", fold(movie_name))
+    return " ".join(ROMAN_NUMERALS.get(word, word) for word in words)
+
+
+# This function is used to get the edit (Levenshtein) distance between two strings.
+# It uses the bit-parallel algorithm of Myers (as described by Hyyro): one column of the
+# distance table is kept as the bits of two integers, so each character is a few integer operations
+
+
+def edit_distance(a, b):
+    if len(a) < len(b):
+        a, b = b, a
+    if not b:
+        return len(a)
+    # Bit i of positions[char] is set when b[i] == char
+    positions = {}
+    for i, char in enumerate(b):
+        positions[char] = positions.get(char, 0) | (1 << i)
+    full = (1 << len(b)) - 1
+    last = 1 << (len(b) - 1)
+    # Bits where the distance goes up (plus) or down (minus) by one from the row above
+    plus, minus, distance = full, 0, len(b)
+    for char in a:
+        eq = positions.get(char, 0)
+        xv = eq | minus
+        xh = (((eq & plus) + plus) ^ plus) | eq
+        hp = minus | (~(xh | plus) & full)
+        hm = plus & xh
+        if hp & last:
+            distance += 1
+        elif hm & last:
+            distance -= 1
+        hp = ((hp << 1) | 1) & full
+        hm = (hm << 1) & full
+        plus = hm | (~(xv | hp) & full)
+        minus = hp & xv
+    return distance
+
+
+# This class is used to find titles that are within a small edit distance of a title (a BK-tree).
+# Every node keeps its children by their distance to it, so a search only follows the
+# children whose distance can still be in range
+
+
+class TitleTree:
+    def __init__(self):
+        self.build([])
+
+    def build(self, movies):
+        # Each node is [normalized title, set of movie IDs, {distance: child node}]
+        self.root = None
+        self._titles = {}
+        # Nodes whose movies have all been removed (they stay in the tree until it is rebuilt)
+        self._empty = 0
+        self._movies = {}
+        for movie in movies:
+            self.add(movie)
+
+    def add(self, movie):
+        title = normalize_title(movie.movie_name)
+        self._movies[movie.id] = movie
+        node = self._titles.get(title)
+        if node is not None:
+            if not node[1]:
+                self._empty -= 1
+            node[1].add(movie.id)
+            return
+        node = [title, {movie.id}, {}]
+        self._titles[title] = node
+        if self.root is None:
+            self.root = node
+            return
+        parent = self.root
+        while True:
+            distance = edit_distance(title, parent[0])
+            child = parent[2].get(distance)
+            if child is None:
+                parent[2][distance] = node
+                return
+            parent = child
+
+    def discard(self, movie):
+        node = self._titles.get(normalize_title(movie.movie_name))
+        if node is None or movie.id not in node[1]:
+            return
+        node[1].discard(movie.id)
+        del self._movies[movie.id]
+        if not node[1]:
+            self._empty += 1
+            if self._empty > max(len(self._titles) // 2, 100):
+                self.build(list(self._movies.values()))
+
+    def similar(self, movie_name, max_distance):
+        # Returns the movies whose normalized title is within max_distance edits, closest first
+        title = normalize_title(movie_name)
+        matches = []
+        nodes = [self.root] if self.root is not None else []
+        while nodes:
+            node = nodes.pop()
+            distance = edit_distance(title, node[0])
+            if distance <= max_distance and node[1]:
+                matches.append((distance, node))
+            # By the triangle inequality only children in this range can be close enough
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    nodes.append(child)
+        matches.sort(key=lambda match: match[0])
+        return [self._movies[movie_id] for _, node in matches for movie_id in node[1]]
+
+
+# This function is used to find the movies whose normalized title is within max_distance edits of
+# a title by comparing the titles one by one (for movies that are not in a TitleTree yet), closest first
+
+
+def similar_by_scan(movies, movie_name, max_distance):
+    title = normalize_title(movie_name)
+    matches = []
+    for movie in movies:
+        other = normalize_title(movie.movie_name)
+        # Titles whose lengths differ by more than max_distance cannot be close enough
+        if abs(len(other) - len(title)) <= max_distance:
+            distance = edit_distance(title, other)
+            if distance <= max_distance:
+                matches.append((distance, movie))
+    matches.sort(key=lambda match: match[0])
+    return [movie for _, movie in matches]
+
+
+# This class is used to keep the IDs of the movies sorted by one field. The entries are
+# (key, position the movie was added in, movie ID) tuples kept sorted with bisect, so a change
+# only inserts or removes one entry and a page of the sorted catalog is a slice
+
+
+class SortedView:
+    def __init__(self, key):
+        self.key = key
+        self._entries = []
+
+    def build(self, movies_and_orders):
+        self._entries = sorted((self.key(movie), order, movie.id) for movie, order in movies_and_orders)
+
+    def add(self, movie, order):
+        bisect.insort(self._entries, (self.key(movie), order, movie.id))
+
+    def discard(self, movie, order):
+        entry = (self.key(movie), order, movie.id)
+        i = bisect.bisect_left(self._entries, entry)
+        if i < len(self._entries) and self._entries[i] == entry:
+            del self._entries[i]
+
+    def ids(self, start=0, stop=None):
+        return [movie_id for _, _, movie_id in self._entries[start:stop]]
+
+    # Returns the IDs of up to limit movies whose key starts with prefix, in key order
+    def with_prefix(self, prefix, limit):
+        movie_ids = []
+        i = bisect.bisect_left(self._entries, (prefix,))
+        while i < len(self._entries) and len(movie_ids) < limit and self._entries[i][0].startswith(prefix):
+            movie_ids.append(self._entries[i][2])
+            i += 1
+        return movie_ids
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Sort field -> key of a movie in that sorted view. Genres are compared as one string (like the
+# genre_sort column of the SQLite store) instead of as lists, and "added" is the catalog order
+SORT_KEYS = {
+    "movie_name": lambda movie: movie.movie_name,
+    "year": lambda movie: movie.year,
+    "genre": lambda movie: "\x1f".join(movie.genre),
+    "director": lambda movie: movie.director,
+    "added": lambda movie: 0,
+}
+
+# The binary snapshot starts with a header: magic, format version, number of movies, journal sequence
+# number, CRC-32 of the payload and payload size. The payload has a string table (every distinct
+# string once, so repeated directors and genres are shared) and columns of indexes into it:
+#   number of strings, number of them before the descriptions, size of the text,
+#   number of genre references                                        (4 x uint32)
+#   length of each string in bytes                                    (uint32 per string)
+#   the strings, separated by NUL characters                          (UTF-8)
+#   id, movie_name, year, director and description columns            (uint32 per movie each)
+#   where the genres of each movie start in the genre references      (uint32 per movie + 1)
+#   genre references                                                  (uint32 each)
+# The descriptions are at the end of the string table, so they can be left out when it is read.
+# All numbers are little-endian
+SNAPSHOT_MAGIC = b"UMSN"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct("<4sHIQIQ")
+SNAPSHOT_COUNTS = struct.Struct("<IIII")
+SNAPSHOT_FIELDS = ("id", "movie_name", "year", "director", "description")
+
+# This function is used to get the bytes of an array of uint32 in little-endian order
+
+
+def uint32_bytes(values):
+    values = array.array("I", values)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tobytes()
+
+
+# This function is used to read an array of uint32 in little-endian order
+
+
+def uint32_array(data):
+    values = array.array("I")
+    values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+# This function is used to write the catalog ({"movies": [...], "seq": n}) as a binary snapshot.
+# It is written to a temporary file first so a crash never leaves a truncated snapshot
+
+
+def write_binary_snapshot(path, data):
+    movies = data["movies"]
+    strings = {}
+    columns = [[strings.setdefault(movie[field], len(strings)) for movie in movies] for field in SNAPSHOT_FIELDS[:-1]]
+    genre_starts = [0]
+    genre_refs = []
+    for movie in movies:
+        for genre in movie["genre"]:
+            genre_refs.append(strings.setdefault(genre, len(strings)))
+        genre_starts.append(len(genre_refs))
+    head_count = len(strings)
+    columns.append([strings.setdefault(movie["description"], len(strings)) for movie in movies])
+    encoded = [string.encode("utf-8") for string in strings]
+    text = b"\x00".join(encoded)
+    payload = b"".join([
+        SNAPSHOT_COUNTS.pack(len(strings), head_count, len(text), len(genre_refs)),
+        uint32_bytes(len(string) for string in encoded),
+        text,
+        *(uint32_bytes(column) for column in columns),
+        uint32_bytes(genre_starts),
+        uint32_bytes(genre_refs),
+    ])
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(movies), data.get("seq", 0),
+                                  zlib.crc32(payload), len(payload))
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as snapshot_file:
+        snapshot_file.write(header)
+        snapshot_file.write(payload)
+    os.replace(tmp_path, path)
+
+
+# This class is used to read strings of a binary snapshot only when they are needed. The file is
+# mapped into memory, so only the pages that are read are loaded (and the system can drop them
+# again). The mapping stays valid after a newer snapshot replaces the file
+
+
+class SnapshotText:
+    def __init__(self, snapshot_file, start, lengths):
+        self._map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._start = start
+        # Where each string starts in the text, and where the text ends
+        self._offsets = array.array("I", itertools.accumulate((length + 1 for length in lengths), initial=0))
+
+    # Size in bytes of the first count strings (with the NULs between them)
+    def size(self, count):
+        return max(self._offsets[count] - 1, 0)
+
+    def text(self, number):
+        return str(self._map[self._start + self._offsets[number]:self._start + self._offsets[number + 1] - 1], "utf-8")
+
+
+# This function is used to read a binary snapshot back into {"movies": [Movie, ...], "seq": n}.
+# With lazy_descriptions the descriptions are left in the file until they are used.
+# Raises ValueError if the file is not a snapshot of this version or is damaged
+
+
+def read_binary_snapshot(path, lazy_descriptions=False):
+    with open(path, "rb") as snapshot_file:
+        data = snapshot_file.read()
+        if len(data) < SNAPSHOT_HEADER.size:
+            raise ValueError("truncated header")
+        magic, version, count, seq, checksum, size = SNAPSHOT_HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError("not a movie snapshot")
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(f"unsupported snapshot version {version}")
+        payload = memoryview(data)[SNAPSHOT_HEADER.size:]
+        if len(payload) != size or zlib.crc32(payload) != checksum:
+            raise ValueError("checksum mismatch")
+
+        string_count, head_count, text_size, genre_ref_count = SNAPSHOT_COUNTS.unpack_from(payload)
+        position = SNAPSHOT_COUNTS.size
+        sections = []
+        for section_size in (4 * string_count, text_size, 4 * len(SNAPSHOT_FIELDS) * count, 4 * (count + 1),
+                             4 * genre_ref_count):
+            sections.append(payload[position:position + section_size])
+            position += section_size
+        lengths, text, columns, genre_starts, genre_refs = sections
+        lengths = uint32_array(lengths)
+        snapshot_text = None
+        if lazy_descriptions:
+            # Only the strings before the descriptions are decoded
+            snapshot_text = SnapshotText(snapshot_file, SNAPSHOT_HEADER.size + SNAPSHOT_COUNTS.size + 4 * string_count,
+                                         lengths)
+            string_count = head_count
+            text = text[:snapshot_text.size(head_count)]
+    # The whole text is decoded at once and split into the strings. If a string itself has a NUL
+    # in it, the text is cut by the lengths of the strings instead
+    decoded = str(text, "utf-8")
+    if string_count and decoded.count("\x00") == string_count - 1:
+        strings = decoded.split("\x00")
     else:
-        movie_list = []
-        for i, movie in enumerate(data["movies"]):
-            movie_list.append(
-                f"{i+1}. {movie['movie_name']} (UID: {movie['id']})")
-        return "\n".join(movie_list)
+        strings = []
+        position = 0
+        for length in lengths[:string_count]:
+            strings.append(str(text[position:position + length], "utf-8"))
+            position += length + 1
+    columns = uint32_array(columns).tolist()
+    genre_starts = uint32_array(genre_starts).tolist()
+
+    # Nothing built here can be garbage, so the collector would only slow the load down
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        genre_refs = [strings[ref] for ref in uint32_array(genre_refs).tolist()]
+        # Each field is turned into a column of strings, and the movies are built from the columns.
+        # Descriptions left on disk are kept as the numbers of their strings
+        ids, names, years, directors = [[strings[ref] for ref in columns[i * count:(i + 1) * count]]
+                                        for i in range(len(SNAPSHOT_FIELDS) - 1)]
+        descriptions = columns[-count:] if count else []
+        if not lazy_descriptions:
+            descriptions = [strings[ref] for ref in descriptions]
+        genres = [genre_refs[start:end] for start, end in zip(genre_starts, genre_starts[1:])]
+        movies = [Movie(movie_id, name, year, director, description, genre, snapshot_text)
+                  for movie_id, name, year, director, description, genre
+                  in zip(ids, names, years, directors, descriptions, genres)]
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return {"movies": movies, "seq": seq}
+
+
+# This class is used to keep the movie catalog in memory (loaded once from movies.json)
+# and to save it back to disk from a debounced background writer
+
+
+class MovieStore:
+    def __init__(self, path="movies.json", save_delay=2.0, snapshot_path="movies.snapshot", lazy_descriptions=False,
+                 defer_indexes=False):
+        self.path = path
+        # The catalog is also saved as a binary snapshot (None to turn it off), which loads much
+        # faster than movies.json. movies.json is still written, for export and for editing by hand
+        self.snapshot_path = snapshot_path
+        # Leave the descriptions in the binary snapshot until they are used (they are most of its text)
+        self.lazy_descriptions = lazy_descriptions
+        # Leave the search indexes of the loaded movies to build_indexes, so the catalog can be used
+        # (searches scan it) while they are built
+        self.defer_indexes = defer_indexes
+        # Movie ID -> movie, for the loaded movies that are not in the search indexes yet
+        self._unindexed = {}
+        # Number of seconds to wait after a write before saving, so bursts of writes are saved once
+        self.save_delay = save_delay
+        # Movie ID -> movie, in the order the movies were added
+        self.movies = {}
+        # Goes up on every change of the catalog (so cached views of it can tell they are stale)
+        self.version = 0
+        self._lock = threading.RLock()
+        self._write_lock = threading.Lock()
+        self._save_timer = None
+        self._dirty = False
+        self.load()
+
+    def load(self):
+        data = self._read_snapshot()
+        with self._lock:
+            self._set_movies(data["movies"])
+
+    def _set_movies(self, movies):
+        self.version += 1
+        self.movies = {movie.id: movie for movie in movies}
+        # Case-folded title -> IDs of the movies with that title, and movie ID -> position it
+        # was added in (to keep results in catalog order)
+        self._by_name = {}
+        self._order = {}
+        self._next_order = 0
+        self._token_index = TokenIndex(["movie_name", "director", "description", "genre"])
+        self._trigram_index = TrigramIndex(["movie_name", "director", "description"])
+        self._title_tree = TitleTree()
+        self._sorted_views = {field: SortedView(key) for field, key in SORT_KEYS.items()}
+        # Case-folded titles and IDs, for autocomplete
+        self._sorted_views["folded_name"] = SortedView(lambda movie: fold(movie.movie_name))
+        self._sorted_views["id"] = SortedView(lambda movie: movie.id)
+        for movie in movies:
+            self._index(movie, build=True)
+        if self.defer_indexes:
+            self._unindexed = dict(self.movies)
+        else:
+            self._token_index.build(movies)
+            self._trigram_index.build(movies)
+            self._title_tree.build(movies)
+        for view in self._sorted_views.values():
+            view.build((movie, self._order[movie.id]) for movie in self.movies.values())
+
+    def _index(self, movie, build=False):
+        self._by_name.setdefault(fold(movie.movie_name), []).append(movie.id)
+        if movie.id not in self._order:
+            self._order[movie.id] = self._next_order
+            self._next_order += 1
+        # While the catalog is loaded the indexes are built in one go instead
+        if not build:
+            # Until build_indexes is done, new movies wait for it with the rest
+            if self.defer_indexes:
+                self._unindexed[movie.id] = movie
+            else:
+                self._token_index.add(movie)
+                self._trigram_index.add(movie)
+                self._title_tree.add(movie)
+            for view in self._sorted_views.values():
+                view.add(movie, self._order[movie.id])
+
+    def _unindex(self, movie):
+        name = fold(movie.movie_name)
+        self._by_name[name].remove(movie.id)
+        if not self._by_name[name]:
+            del self._by_name[name]
+        # A movie that is not in the search indexes yet only leaves the ones waiting for them
+        if self._unindexed.pop(movie.id, None) is None:
+            self._token_index.discard(movie)
+            self._trigram_index.discard(movie)
+            self._title_tree.discard(movie)
+        for view in self._sorted_views.values():
+            view.discard(movie, self._order[movie.id])
+
+    def all(self):
+        return list(self.movies.values())
+
+    def get(self, movie_id):
+        return self.movies.get(movie_id)
+
+    def find_by_name(self, movie_name):
+        movie_ids = self._by_name.get(fold(movie_name))
+        if not movie_ids:
+            return None
+        return self.movies[movie_ids[0]]
+
+    # Builds the search indexes of the movies loaded with defer_indexes, a slice of slice_seconds at
+    # a time on the event loop, so commands keep running (and no thread changes the indexes under them).
+    # Searches check every movie until the last slice, so the word lists of the token index are only
+    # sorted once, at the end
+    async def build_indexes(self, slice_seconds=0.02):
+        started = time.perf_counter()
+        while True:
+            with self._lock:
+                slice_end = time.perf_counter() + slice_seconds
+                # At least one movie per slice, so the build always gets done
+                while self._unindexed:
+                    _, movie = self._unindexed.popitem()
+                    self._token_index.extend((movie,))
+                    self._trigram_index.add(movie)
+                    self._title_tree.add(movie)
+                    if time.perf_counter() >= slice_end:
+                        break
+                if not self._unindexed:
+                    self._token_index.sort_words()
+                    # Changes from here on go straight into the indexes
+                    self.defer_indexes = False
+                    break
+            await asyncio.sleep(0)
+        print(f"Search indexes built in {time.perf_counter() - started:.2f}s")
+
+    def similar_titles(self, movie_name, max_distance):
+        movies = self._title_tree.similar(movie_name, max_distance)
+        if self._unindexed:
+            title = normalize_title(movie_name)
+            movies = sorted(movies + similar_by_scan(list(self._unindexed.values()), movie_name, max_distance),
+                            key=lambda movie: edit_distance(title, normalize_title(movie.movie_name)))
+        return movies
+
+    def search(self, query, search_by):
+        query = fold(query)
+        # Narrow the movies down with the trigram index (or the token index for short queries
+        # and genres), then check each candidate
+        # When most movies are candidates anyway, checking every movie in order is faster
+        max_candidates = len(self.movies) // 4
+        movie_ids = None
+        # Until the search indexes are built every movie is checked
+        indexed = not self._unindexed
+        if indexed and search_by in self._trigram_index.fields and len(query) >= 3:
+            movie_ids = self._trigram_index.candidates(search_by, query, max_candidates)
+        elif indexed and search_by in self._token_index.fields:
+            movie_ids = self._token_index.candidates(search_by, query)
+        if movie_ids is None or len(movie_ids) > max_candidates:
+            candidates = self.movies.values()
+        else:
+            candidates = [self.movies[movie_id] for movie_id in sorted(movie_ids, key=self._order.get)]
+        if search_by == "genre":
+            # A genre search matches any single genre of the movie
+            return [movie for movie in candidates
+                    if any(query in fold(genre) for genre in movie.genre)]
+        return [movie for movie in candidates if query in fold(getattr(movie, search_by))]
+
+    def sort(self, sort_by):
+        with self._lock:
+            return [self.movies[movie_id] for movie_id in self._sorted_views[sort_by].ids()]
+
+    def count(self):
+        return len(self.movies)
+
+    # Returns count movies from position start, sorted by a field of SORT_FIELDS
+    def page(self, sort_by, start, count):
+        with self._lock:
+            return [self.movies[movie_id] for movie_id in self._sorted_views[sort_by].ids(start, start + count)]
+
+    # Returns up to limit movies whose title (case-insensitive) or ID starts with text
+    def complete(self, text, limit=25):
+        text = fold(text)
+        with self._lock:
+            movie_ids = self._sorted_views["folded_name"].with_prefix(text, limit)
+            movie_ids += self._sorted_views["id"].with_prefix(text, limit - len(movie_ids))
+            return [self.movies[movie_id] for movie_id in dict.fromkeys(movie_ids)]
+
+    def add(self, movie):
+        self._commit({"op": "add", "movie": movie})
+
+    def add_many(self, movies):
+        # All the movies are saved together (one journal record in journal mode)
+        self._commit({"op": "add_many", "movies": movies})
+
+    def update(self, movie, field, value):
+        self._commit({"op": "update", "id": movie.id, "field": field, "value": value})
+
+    def delete(self, movie):
+        self._commit({"op": "delete", "id": movie.id})
+
+    def _commit(self, record):
+        # Apply a change in memory and then persist it
+        with self._lock:
+            self._apply(record)
+            self.version += 1
+            self._persist(record)
+
+    def _apply(self, record):
+        if record["op"] == "add":
+            self.movies[record["movie"].id] = record["movie"]
+            self._index(record["movie"])
+            return
+        if record["op"] == "add_many":
+            for movie in record["movies"]:
+                self.movies[movie.id] = movie
+                self._index(movie)
+            return
+        movie = self.movies.get(record["id"])
+        if movie is None:
+            return
+        self._unindex(movie)
+        if record["op"] == "update":
+            setattr(movie, record["field"], record["value"])
+            self._index(movie)
+        elif record["op"] == "delete":
+            del self.movies[movie.id]
+            del self._order[movie.id]
+
+    def _persist(self, record):
+        self._schedule_save()
+
+    def _schedule_save(self):
+        self._dirty = True
+        # If a save is already pending it will pick up this change as well
+        if self._save_timer is None:
+            self._save_timer = threading.Timer(self.save_delay, self.flush)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def flush(self):
+        with self._lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                self._save_timer = None
+            if not self._dirty:
+                return
+            self._dirty = False
+            # Copy the records so the file can be written without holding the lock
+            movies = [movie.to_dict() for movie in self.movies.values()]
+        self._write_snapshot({"movies": movies})
+
+    def _read_snapshot(self):
+        # The binary snapshot is used unless movies.json was changed after it was written
+        if self.snapshot_path and os.path.exists(self.snapshot_path) and (
+                not os.path.exists(self.path) or os.path.getmtime(self.path) <= os.path.getmtime(self.snapshot_path)):
+            try:
+                with metrics.time("store", "read_binary_snapshot"):
+                    return read_binary_snapshot(self.snapshot_path, self.lazy_descriptions)
+            except ValueError as e:
+                print(f"Ignoring damaged snapshot {self.snapshot_path} ({e}), loading {self.path}")
+        try:
+            with metrics.time("store", "read_snapshot"), open(self.path, "r") as json_file:
+                data = json.load(json_file)
+        except FileNotFoundError:
+            return {"movies": []}
+        data["movies"] = [Movie.from_dict(movie) for movie in data["movies"]]
+        return data
+
+    def _write_snapshot(self, data):
+        # Write to a temporary file first so a crash never leaves a truncated movies.json
+        with self._write_lock, metrics.time("store", "write_snapshot"):
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as json_file:
+                json.dump(data, json_file)
+            os.replace(tmp_path, self.path)
+            # Written after movies.json, so it is never older than the movies.json it matches
+            if self.snapshot_path:
+                write_binary_snapshot(self.snapshot_path, data)
+
+
+# This class is used to store the movie catalog as a snapshot (movies.json) plus an append-only
+# journal of changes, so each write only appends one line no matter how big the catalog is
+
+
+class JournalMovieStore(MovieStore):
+    def __init__(self, path="movies.json", journal_path="movies.journal.jsonl", compact_size=1024 * 1024,
+                 snapshot_path="movies.snapshot", lazy_descriptions=False, defer_indexes=False):
+        self.journal_path = journal_path
+        # Size in bytes after which the journal is folded back into the snapshot
+        self.compact_size = compact_size
+        self._seq = 0
+        self._journal = None
+        self._compacting = False
+        super().__init__(path, snapshot_path=snapshot_path, lazy_descriptions=lazy_descriptions,
+                         defer_indexes=defer_indexes)
+
+    def load(self):
+        data = self._read_snapshot()
+        with self._lock:
+            self._set_movies(data["movies"])
+            # Records up to this sequence number are already part of the snapshot
+            self._seq = data.get("seq", 0)
+            compacting_path = f"{self.journal_path}.compacting"
+            for path in (compacting_path, self.journal_path):
+                self._replay(path)
+            self._journal = open(self.journal_path, "a+")
+            # Terminate a partially written last record so the next append starts on its own line
+            if self._journal.tell() > 0:
+                self._journal.seek(self._journal.tell() - 1)
+                if self._journal.read(1) != "\n":
+                    self._journal.write("\n")
+        # A compaction was interrupted, so finish it now that everything has been replayed
+        if os.path.exists(compacting_path):
+            self._write_snapshot({"movies": [movie.to_dict() for movie in self.movies.values()], "seq": self._seq})
+            os.remove(compacting_path)
+
+    def _replay(self, path):
+        try:
+            journal_file = open(path, "r")
+        except FileNotFoundError:
+            return
+        with journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except json.decoder.JSONDecodeError:
+                    # A crash in the middle of an append only loses that last record
+                    print(f"Skipping damaged journal record in {path}")
+                    continue
+                if record["seq"] <= self._seq:
+                    continue
+                if record["op"] == "add":
+                    record["movie"] = Movie.from_dict(record["movie"])
+                elif record["op"] == "add_many":
+                    record["movies"] = [Movie.from_dict(movie) for movie in record["movies"]]
+                self._apply(record)
+                self._seq = record["seq"]
+
+    def _persist(self, record):
+        self._seq += 1
+        record = dict(record, seq=self._seq)
+        with metrics.time("store", "journal_append"):
+            self._journal.write(json.dumps(record, default=Movie.to_dict) + "\n")
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+        if not self._compacting and self._journal.tell() >= self.compact_size:
+            self._compacting = True
+            threading.Thread(target=self.compact, daemon=True).start()
+
+    def compact(self):
+        try:
+            with self._lock:
+                # Copy the records so the snapshot can be written without holding the lock
+                movies = [movie.to_dict() for movie in self.movies.values()]
+                seq = self._seq
+                # Move the current journal aside and start a new one for the writes that follow
+                compacting_path = f"{self.journal_path}.compacting"
+                self._journal.close()
+                if os.path.exists(compacting_path):
+                    # The last snapshot could not be written, so those records are only in the file
+                    # that was moved aside. The journal is added to it (a crash before the journal is
+                    # removed only leaves records that replay skips by their sequence numbers)
+                    with open(compacting_path, "a") as compacting_file, open(self.journal_path, "r") as journal_file:
+                        compacting_file.write(journal_file.read())
+                        compacting_file.flush()
+                        os.fsync(compacting_file.fileno())
+                    os.remove(self.journal_path)
+                else:
+                    os.replace(self.journal_path, compacting_path)
+                self._journal = open(self.journal_path, "a")
+            self._write_snapshot({"movies": movies, "seq": seq})
+            os.remove(compacting_path)
+        finally:
+            self._compacting = False
+
+    def flush(self):
+        # Every change is already in the journal, so there is nothing to save
+        with self._lock:
+            self._journal.flush()
+
+# This class is used to store the movie catalog in a SQLite database with indexed lookups.
+# It offers the same operations as MovieStore and every write runs in its own transaction
+
+
+class SQLiteMovieStore:
+    def __init__(self, path="movies.db", json_path="movies.json", defer_indexes=False):
+        self.path = path
+        # The store is opened in a worker thread at startup and then used from the event loop
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        # Goes up on every change of the catalog (so cached views of it can tell they are stale)
+        self.version = 0
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self._create_schema()
+        # The titles are also kept in memory for near-duplicate checks. With defer_indexes the tree
+        # is filled by build_indexes, and until then the titles waiting for it are compared one by one
+        self._title_tree = TitleTree()
+        titles = (Movie(row["id"], row["movie_name"])
+                  for row in self.conn.execute("SELECT id, movie_name FROM movies ORDER BY seq"))
+        # Movie ID -> movie (ID and title only), for the titles that are not in the tree yet
+        self._unindexed = {}
+        if defer_indexes:
+            self._unindexed = {movie.id: movie for movie in titles}
+        else:
+            self._title_tree.build(titles)
+        # Copy the existing movies.json into the database once. The copy is marked done in the same
+        # transaction as the movies, so one that failed is tried again on the next start. Databases
+        # made before the mark existed are marked once they have movies
+        migrated = self.conn.execute("SELECT 1 FROM store_info WHERE key = 'json_migrated'").fetchone()
+        if not migrated and self.count():
+            with self.conn:
+                self.conn.execute("INSERT INTO store_info (key, value) VALUES ('json_migrated', '')")
+        elif not migrated and os.path.exists(json_path):
+            count = migrate_json_to_sqlite(json_path, self)
+            print(f"Migrated {count} movies from {json_path} to {path}")
+        # Made after the migration, so the copied movies are indexed in one go
+        self._create_full_text_index()
+
+    def _create_schema(self):
+        with self.conn:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS movies (
+                    seq INTEGER PRIMARY KEY,
+                    id TEXT NOT NULL UNIQUE,
+                    movie_name TEXT NOT NULL,
+                    movie_name_folded TEXT NOT NULL,
+                    year TEXT NOT NULL,
+                    director TEXT NOT NULL,
+                    director_folded TEXT NOT NULL,
+                    description TEXT NOT NULL,
+                    description_folded TEXT NOT NULL,
+                    genre_sort TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS movie_genres (
+                    movie_id TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    genre TEXT NOT NULL,
+                    genre_folded TEXT NOT NULL,
+                    PRIMARY KEY (movie_id, position)
+                );
+                CREATE INDEX IF NOT EXISTS idx_movies_name ON movies (movie_name);
+                CREATE INDEX IF NOT EXISTS idx_movies_name_folded ON movies (movie_name_folded);
+                CREATE INDEX IF NOT EXISTS idx_movies_year ON movies (year);
+                CREATE INDEX IF NOT EXISTS idx_movies_director ON movies (director_folded);
+                CREATE INDEX IF NOT EXISTS idx_movies_director_sort ON movies (director);
+                CREATE INDEX IF NOT EXISTS idx_movies_genre_sort ON movies (genre_sort);
+                CREATE INDEX IF NOT EXISTS idx_movie_genres_genre ON movie_genres (genre_folded);
+                -- Settings of the database itself (such as whether movies.json was copied into it)
+                CREATE TABLE IF NOT EXISTS store_info (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+                -- Every genre used so far, so a genre search only scans these before using idx_movie_genres_genre
+                CREATE TABLE IF NOT EXISTS genre_names (genre_folded TEXT PRIMARY KEY) WITHOUT ROWID;
+            """)
+            self.conn.execute("INSERT OR IGNORE INTO genre_names SELECT DISTINCT genre_folded FROM movie_genres")
+
+    # Creates the trigram index of the folded text columns, kept in step with the movies table by
+    # triggers. SQLite builds without FTS5 search by scanning instead
+    def _create_full_text_index(self):
+        new_index = not self.conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'movies_fts'").fetchone()
+        try:
+            # One transaction, so a database made before the index existed is never left with an empty one
+            self.conn.executescript("""
+                BEGIN;
+                CREATE VIRTUAL TABLE IF NOT EXISTS movies_fts USING fts5(
+                    movie_name_folded, director_folded, description_folded,
+                    content='movies', content_rowid='seq', tokenize='trigram case_sensitive 1');
+                CREATE TRIGGER IF NOT EXISTS movies_fts_insert AFTER INSERT ON movies BEGIN
+                    INSERT INTO movies_fts (rowid, movie_name_folded, director_folded, description_folded)
+                    VALUES (new.seq, new.movie_name_folded, new.director_folded, new.description_folded);
+                END;
+                CREATE TRIGGER IF NOT EXISTS movies_fts_delete AFTER DELETE ON movies BEGIN
+                    INSERT INTO movies_fts (movies_fts, rowid, movie_name_folded, director_folded, description_folded)
+                    VALUES ('delete', old.seq, old.movie_name_folded, old.director_folded, old.description_folded);
+                END;
+                CREATE TRIGGER IF NOT EXISTS movies_fts_update
+                AFTER UPDATE OF movie_name_folded, director_folded, description_folded ON movies BEGIN
+                    INSERT INTO movies_fts (movies_fts, rowid, movie_name_folded, director_folded, description_folded)
+                    VALUES ('delete', old.seq, old.movie_name_folded, old.director_folded, old.description_folded);
+                    INSERT INTO movies_fts (rowid, movie_name_folded, director_folded, description_folded)
+                    VALUES (new.seq, new.movie_name_folded, new.director_folded, new.description_folded);
+                END;
+            """ + ("INSERT INTO movies_fts (movies_fts) VALUES ('rebuild');" if new_index else "") + "COMMIT;")
+            self.full_text = True
+        except sqlite3.OperationalError as e:
+            self.conn.rollback()
+            print(f"Searching {self.path} without a full-text index ({e})")
+            self.full_text = False
+
+    # The genre column of a movie is rebuilt from the movie_genres table in position order
+    _select = """
+        SELECT m.id, m.movie_name, m.year, m.director, m.description,
+               (SELECT group_concat(g.genre, char(31)) FROM
+                   (SELECT genre FROM movie_genres WHERE movie_id = m.id ORDER BY position) AS g) AS genre
+        FROM movies AS m
+    """
+
+    def _to_movie(self, row):
+        return Movie(row["id"], row["movie_name"], row["year"], row["director"], row["description"],
+                     row["genre"].split("\x1f") if row["genre"] else [])
+
+    def _query(self, where="", params=(), order_by="m.seq", limit=""):
+        with metrics.time("store", "sqlite_query"):
+            rows = self.conn.execute(f"{self._select} {where} ORDER BY {order_by} {limit}", params)
+            return [self._to_movie(row) for row in rows]
+
+    def all(self):
+        return self._query()
+
+    def get(self, movie_id):
+        movies = self._query("WHERE m.id = ?", (movie_id,))
+        return movies[0] if movies else None
+
+    def find_by_name(self, movie_name):
+        movies = self._query("WHERE m.movie_name_folded = ?", (fold(movie_name),))
+        return movies[0] if movies else None
+
+    def similar_titles(self, movie_name, max_distance):
+        movies = self._title_tree.similar(movie_name, max_distance)
+        if self._unindexed:
+            title = normalize_title(movie_name)
+            movies = sorted(movies + similar_by_scan(list(self._unindexed.values()), movie_name, max_distance),
+                            key=lambda movie: edit_distance(title, normalize_title(movie.movie_name)))
+        return [self.get(movie.id) for movie in movies]
+
+    # Fills the title tree of a store opened with defer_indexes, a slice of slice_seconds at a time
+    # on the event loop
+    async def build_indexes(self, slice_seconds=0.02):
+        started = time.perf_counter()
+        while self._unindexed:
+            slice_end = time.perf_counter() + slice_seconds
+            # At least one title per slice, so the build always gets done
+            while self._unindexed:
+                self._title_tree.add(self._unindexed.popitem()[1])
+                if time.perf_counter() >= slice_end:
+                    break
+            await asyncio.sleep(0)
+        print(f"Title index built in {time.perf_counter() - started:.2f}s")
+
+    def _discard_title(self, movie):
+        # A title that is not in the tree yet only leaves the ones waiting for it
+        if self._unindexed.pop(movie.id, None) is None:
+            self._title_tree.discard(movie)
+
+    def search(self, query, search_by):
+        query = fold(query)
+        if search_by == "genre":
+            return self._query(
+                "WHERE m.id IN (SELECT movie_id FROM movie_genres WHERE genre_folded IN "
+                "(SELECT genre_folded FROM genre_names WHERE instr(genre_folded, ?) > 0))", (query,))
+        if search_by == "year":
+            return self._query("WHERE instr(lower(m.year), ?) > 0", (query,))
+        column = f"{search_by}_folded"
+        # The trigram index finds any text of 3 or more characters (shorter text is searched by scanning)
+        if self.full_text and len(query) >= 3:
+            phrase = '"' + query.replace('"', '""') + '"'
+            return self._query("WHERE m.seq IN (SELECT rowid FROM movies_fts WHERE movies_fts MATCH ?)",
+                               (f"{column} : {phrase}",))
+        return self._query(f"WHERE instr(m.{column}, ?) > 0", (query,))
+
+    # Each sort order is served by an index, so no sorting happens in Python
+    _sort_columns = {"movie_name": "m.movie_name", "year": "m.year", "genre": "m.genre_sort",
+                     "director": "m.director", "added": "m.seq"}
+
+    def sort(self, sort_by):
+        return self._query(order_by=f"{self._sort_columns[sort_by]}, m.seq")
+
+    def count(self):
+        return self.conn.execute("SELECT count(*) FROM movies").fetchone()[0]
+
+    def page(self, sort_by, start, count):
+        return self._query(order_by=f"{self._sort_columns[sort_by]}, m.seq", limit="LIMIT ? OFFSET ?",
+                           params=(count, start))
+
+    def complete(self, text, limit=25):
+        # Prefix ranges on the indexed columns (every string with the prefix sorts below prefix + U+10FFFF)
+        prefix_range = (fold(text), fold(text) + "\U0010ffff")
+        movies = self._query("WHERE m.movie_name_folded >= ? AND m.movie_name_folded < ?",
+                             prefix_range + (limit,), order_by="m.movie_name_folded", limit="LIMIT ?")
+        movies += self._query("WHERE m.id >= ? AND m.id < ?", prefix_range + (limit - len(movies),),
+                              order_by="m.id", limit="LIMIT ?")
+        return list({movie.id: movie for movie in movies}.values())
+
+    def _insert(self, movie):
+        self.conn.execute(
+            "INSERT INTO movies (id, movie_name, movie_name_folded, year, director, director_folded, "
+            "description, description_folded, genre_sort) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (movie.id, movie.movie_name, fold(movie.movie_name), movie.year,
+             movie.director, fold(movie.director), movie.description,
+             fold(movie.description), "\x1f".join(movie.genre)))
+        self._insert_genres(movie.id, movie.genre)
+
+    def _insert_genres(self, movie_id, genres):
+        self.conn.executemany(
+            "INSERT INTO movie_genres (movie_id, position, genre, genre_folded) VALUES (?, ?, ?, ?)",
+            [(movie_id, position, genre, fold(genre)) for position, genre in enumerate(genres)])
+        self.conn.executemany("INSERT OR IGNORE INTO genre_names (genre_folded) VALUES (?)",
+                              [(fold(genre),) for genre in genres])
+
+    def add(self, movie):
+        with metrics.time("store", "sqlite_write"), self.conn:
+            self._insert(movie)
+        self.version += 1
+        self._title_tree.add(movie)
+
+    # info is saved in store_info in the same transaction as the movies
+    def add_many(self, movies, info=None):
+        with metrics.time("store", "sqlite_write"), self.conn:
+            for movie in movies:
+                self._insert(movie)
+            if info:
+                self.conn.executemany("INSERT OR REPLACE INTO store_info (key, value) VALUES (?, ?)", info.items())
+        self.version += 1
+        for movie in movies:
+            self._title_tree.add(movie)
+
+    def update(self, movie, field, value):
+        with metrics.time("store", "sqlite_write"), self.conn:
+            if field == "genre":
+                self.conn.execute("DELETE FROM movie_genres WHERE movie_id = ?", (movie.id,))
+                self._insert_genres(movie.id, value)
+                self.conn.execute("UPDATE movies SET genre_sort = ? WHERE id = ?",
+                                  ("\x1f".join(value), movie.id))
+            elif field == "year":
+                self.conn.execute("UPDATE movies SET year = ? WHERE id = ?", (value, movie.id))
+            elif field in ("movie_name", "director", "description"):
+                self.conn.execute(f"UPDATE movies SET {field} = ?, {field}_folded = ? WHERE id = ?",
+                                  (value, fold(value), movie.id))
+            else:
+                raise ValueError(f"Unknown movie field '{field}'")
+        self.version += 1
+        if field == "movie_name":
+            self._discard_title(movie)
+        setattr(movie, field, value)
+        if field == "movie_name":
+            self._title_tree.add(movie)
+
+    def delete(self, movie):
+        with metrics.time("store", "sqlite_write"), self.conn:
+            self.conn.execute("DELETE FROM movie_genres WHERE movie_id = ?", (movie.id,))
+            self.conn.execute("DELETE FROM movies WHERE id = ?", (movie.id,))
+        self.version += 1
+        self._discard_title(movie)
+
+    def flush(self):
+        # Every write is committed in its own transaction, so there is nothing to save
+        pass
+
+
+# This function is used to copy the movies from a movies.json file into a SQLite movie store (in one transaction)
+
+
+def migrate_json_to_sqlite(json_path, sqlite_store):
+    with open(json_path, "r") as json_file:
+        data = json.load(json_file)
+    sqlite_store.add_many([Movie.from_dict(movie) for movie in data["movies"]], info={"json_migrated": json_path})
+    return len(data["movies"])
+
+
+# This function is used to open the movie store selected by the MOVIE_STORAGE setting (with
+# defer_indexes, its search indexes are left to store.build_indexes)
+
+
+def open_movie_store(defer_indexes=False):
+    storage = os.getenv("MOVIE_STORAGE", "json")
+    snapshot_path = os.getenv("MOVIE_SNAPSHOT", "movies.snapshot") or None
+    lazy_descriptions = os.getenv("LAZY_DESCRIPTIONS", "0") == "1"
+    if storage == "journal":
+        return JournalMovieStore(compact_size=int(os.getenv("JOURNAL_COMPACT_SIZE", 1024 * 1024)),
+                                 snapshot_path=snapshot_path, lazy_descriptions=lazy_descriptions,
+                                 defer_indexes=defer_indexes)
+    if storage == "sqlite":
+        return SQLiteMovieStore(os.getenv("MOVIE_DB", "movies.db"), defer_indexes=defer_indexes)
+    return MovieStore(snapshot_path=snapshot_path, lazy_descriptions=lazy_descriptions, defer_indexes=defer_indexes)
+
+
+# Titles within this many edits of a title in the logger (after normalizing them) are treated as duplicates.
+# Titles shorter than 6 characters per allowed edit only allow fewer edits
+DUPLICATE_DISTANCE = int(os.getenv("DUPLICATE_DISTANCE", 2))
+
+# The catalog is loaded once at startup by start_up (in on_ready)
+store = None
+
+# This class is used to look up well-known movies in a local index built from the IMDb datasets
+# (https://developer.imdb.com/non-commercial-datasets/), so they can be added without OpenAI.
+# The index is a SQLite database made by import_imdb; if it does not exist every lookup misses
+
+
+class MovieReference:
+    def __init__(self, path="imdb.db"):
+        self.path = path
+        self.conn = None
+        self.hits = 0
+        self.misses = 0
+
+    def _connect(self):
+        # The index may be imported while the bot is running, so a missing file is checked again
+        if self.conn is None and os.path.exists(self.path):
+            self.conn = sqlite3.connect(self.path)
+        return self.conn
+
+    # Returns a new movie object (without a description), or None if the title is not in the index
+    def lookup(self, movie_name):
+        conn = self._connect()
+        if conn is None:
+            return None
+        row = self._find(conn, normalize_title(movie_name), None)
+        if row is None:
+            # "Dune (1984)" or "Dune 1984" picks the movie of that year
+            match = re.fullmatch(r"(.*?)\W*\(?((?:18|19|20)\d\d)\)?\W*", movie_name)
+            if match and normalize_title(match.group(1)):
+                row = self._find(conn, normalize_title(match.group(1)), match.group(2))
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        tconst, title, year, genres = row
+        directors = [name for (name,) in conn.execute(
+            "SELECT n.name FROM directors AS d JOIN names AS n ON n.nconst = d.nconst "
+            "WHERE d.tconst = ? ORDER BY d.position", (tconst,))]
+        return Movie(uuid.uuid4().hex, title, year, ", ".join(directors), "", genres.split(",") if genres else [])
+
+    def _find(self, conn, title_key, year):
+        # Remakes share a title, so the most voted one (then the newest one) is used
+        query = ("SELECT t.tconst, t.title, t.year, t.genres FROM title_keys AS k "
+                 "JOIN titles AS t ON t.tconst = k.tconst WHERE k.title_key = ?")
+        params = [title_key]
+        if year is not None:
+            query += " AND t.year = ?"
+            params.append(year)
+        return conn.execute(query + " ORDER BY t.votes DESC, t.year DESC LIMIT 1", params).fetchone()
+
+    def stats(self):
+        if self._connect() is None:
+            return f"IMDb index: not imported ({self.path})"
+        (count,) = self.conn.execute("SELECT count(*) FROM titles").fetchone()
+        return f"IMDb index: {count} movies, {self.hits} hits, {self.misses} misses"
+
+
+# This function is used to read the rows of an IMDb dataset file (plain or gzipped) one at a time
+# as lists of columns, with missing values (\N) as None
+
+
+def read_imdb_rows(path):
+    if not os.path.exists(path) and os.path.exists(f"{path}.gz"):
+        path = f"{path}.gz"
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8", newline="\n") as tsv_file:
+        # Skip the header
+        next(tsv_file, None)
+        for line in tsv_file:
+            yield [None if value == "\\N" else value for value in line.rstrip("\n").split("\t")]
+
+
+# This function is used to get the number of an IMDb ID ("tt0111161" -> 111161), which is
+# stored instead of the ID to keep the index small
+
+
+def imdb_number(imdb_id):
+    return int(imdb_id[2:])
+
+
+# This function is used to build the movie reference index from the IMDb datasets in a directory
+# (title.basics.tsv, title.crew.tsv, name.basics.tsv and, if it is there, title.ratings.tsv, plain or
+# gzipped). The files are streamed, so memory use does not depend on their size. The new index
+# replaces the old one only when it is complete. Returns the number of movies in the index
+
+
+def import_imdb(directory, path="imdb.db"):
+    tmp_path = f"{path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    conn.executescript("""
+        PRAGMA journal_mode=OFF;
+        PRAGMA synchronous=OFF;
+        CREATE TABLE titles (
+            tconst INTEGER PRIMARY KEY,
+            title TEXT NOT NULL,
+            year TEXT NOT NULL,
+            genres TEXT,
+            votes INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE title_keys (title_key TEXT NOT NULL, tconst INTEGER NOT NULL);
+        CREATE TABLE directors (tconst INTEGER NOT NULL, position INTEGER NOT NULL, nconst INTEGER NOT NULL);
+        CREATE TABLE names (nconst INTEGER PRIMARY KEY, name TEXT NOT NULL);
+    """)
+
+    def movies():
+        for row in read_imdb_rows(os.path.join(directory, "title.basics.tsv")):
+            # Only movies (not series, episodes or shorts) and not adult titles
+            if row[1] in ("movie", "tvMovie") and row[4] != "1":
+                yield row
+
+    def title_keys(rows):
+        for row in rows:
+            tconst = imdb_number(row[0])
+            conn.execute("INSERT INTO titles (tconst, title, year, genres) VALUES (?, ?, ?, ?)",
+                         (tconst, row[2], row[5] or "", row[8]))
+            keys = {normalize_title(row[2]), normalize_title(row[3] or row[2])}
+            for key in keys:
+                yield key, tconst
+
+    def directors():
+        for row in read_imdb_rows(os.path.join(directory, "title.crew.tsv")):
+            if row[1] is not None:
+                for position, nconst in enumerate(row[1].split(",")):
+                    yield imdb_number(row[0]), position, imdb_number(nconst)
+
+    with conn:
+        conn.executemany("INSERT INTO title_keys VALUES (?, ?)", title_keys(movies()))
+        conn.execute("CREATE INDEX idx_title_keys ON title_keys (title_key)")
+    with conn:
+        # The crew file has every title, so only the directors of the imported movies are kept
+        conn.executemany("INSERT INTO directors SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM titles WHERE tconst = ?)",
+                         ((tconst, position, nconst, tconst) for tconst, position, nconst in directors()))
+        conn.execute("CREATE INDEX idx_directors ON directors (tconst)")
+        conn.execute("CREATE INDEX idx_directors_name ON directors (nconst)")
+    with conn:
+        conn.executemany("INSERT INTO names SELECT ?, ? WHERE EXISTS (SELECT 1 FROM directors WHERE nconst = ?)",
+                         ((imdb_number(row[0]), row[1], imdb_number(row[0]))
+                          for row in read_imdb_rows(os.path.join(directory, "name.basics.tsv"))))
+    ratings_path = os.path.join(directory, "title.ratings.tsv")
+    if os.path.exists(ratings_path) or os.path.exists(f"{ratings_path}.gz"):
+        with conn:
+            conn.executemany("UPDATE titles SET votes = ? WHERE tconst = ?",
+                             ((int(row[2]), imdb_number(row[0])) for row in read_imdb_rows(ratings_path)))
+    (count,) = conn.execute("SELECT count(*) FROM titles").fetchone()
+    conn.execute("VACUUM")
+    conn.close()
+    os.replace(tmp_path, path)
+    return count
+
+
+movie_reference = MovieReference(os.getenv("IMDB_INDEX", "imdb.db"))
+
+# This function is used to get the list of movies from the logger (by reading from the movie store)
+
+
+def get_movie_list(page=0):
+    return render_movie_page("added", page)
+
+
+# Number of movies shown on one page of >movies and >sort
+PAGE_SIZE = 20
+
+# Discord rejects messages longer than this
+MESSAGE_LIMIT = 2000
+
+# This function is used to get the number of pages of the movie list
+
+
+def page_count():
+    return max(1, -(-store.count() // PAGE_SIZE))
+
+
+# This class is used to keep the rendered pages of the movie list, keyed by (sort field, page,
+# catalog version). When the catalog version changes every page is dropped, so a page is only
+# rendered again after a change
+
+
+class PageCache:
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.pages = {}
+        # Catalog version of the pages in the cache
+        self.version = None
+
+    def get(self, sort_by, page, version, render):
+        key = (sort_by, page, version)
+        text = self.pages.get(key)
+        if text is not None:
+            self.hits += 1
+            return text
+        self.misses += 1
+        # Pages of an older version of the catalog are never shown again
+        if version != self.version or len(self.pages) >= self.max_entries:
+            self.pages.clear()
+            self.version = version
+        text = self.pages[key] = render(sort_by, page)
+        return text
+
+    def stats(self):
+        return f"Page cache: {len(self.pages)} pages, {self.hits} hits, {self.misses} misses"
+
+
+page_cache = PageCache()
+
+# This function is used to get one page of the movie list, in the order the movies were added
+# (sort_by="added") or sorted by another field, from the page cache if it did not change
+
+
+def render_movie_page(sort_by, page):
+    return page_cache.get(sort_by, page, store.version, format_movie_page)
+
+
+# This function is used to format one page of the movie list. Only the movies on the page are
+# fetched and formatted
+
+
+def format_movie_page(sort_by, page):
+    start = page * PAGE_SIZE
+    lines = []
+    with metrics.time("index", "page"):
+        movies = store.page(sort_by, start, PAGE_SIZE)
+    for i, movie in enumerate(movies, start):
+        if sort_by == "added":
+            lines.append(f"{i+1}. {movie.movie_name} (UID: {movie.id})")
+        elif sort_by == "movie_name":
+            lines.append(f"{movie.movie_name} (UID: {movie.id})")
+        else:
+            lines.append("-".join([movie.movie_name, field_text(movie, sort_by)]))
+    if not lines:
+        return "No movies found"
+    title = "List of movies" if sort_by == "added" else f"Movies sorted by {sort_by}"
+    text = f"{title} (page {page + 1}/{page_count()}):\n" + "\n".join(lines)
+    if len(text) > MESSAGE_LIMIT:
+        text = text[:MESSAGE_LIMIT - 3] + "..."
+    return text
+
+
+# This class is used to show the movie list one page at a time, with buttons to move between pages.
+# Each page is rendered when it is shown
+
+
+class MoviePages(discord.ui.View):
+    def __init__(self, sort_by, timeout=300):
+        super().__init__(timeout=timeout)
+        self.sort_by = sort_by
+        self.page = 0
+        self.message = None
+        self._update_buttons()
+
+    def render(self):
+        return render_movie_page(self.sort_by, self.page)
+
+    def _update_buttons(self):
+        self.previous_page.disabled = self.page == 0
+        self.next_page.disabled = self.page >= page_count() - 1
+
+    async def _show(self, interaction, page):
+        # The catalog may have shrunk since the last page was shown
+        self.page = max(0, min(page, page_count() - 1))
+        self._update_buttons()
+        await interaction.response.edit_message(content=self.render(), view=self)
+
+    @discord.ui.button(label="Previous", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction, button):
+        await self._show(interaction, self.page - 1)
+
+    @discord.ui.button(label="Next", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction, button):
+        await self._show(interaction, self.page + 1)
+
+    async def on_timeout(self):
+        # Disable the buttons once they stop working
+        if self.message is not None:
+            self.previous_page.disabled = True
+            self.next_page.disabled = True
+            await self.message.edit(view=self)
+
+    # This function is used to send the first page to a channel
+    async def send(self, ctx):
+        self.message = await ctx.send(self.render(), view=self)
+
+    # This function is used to send the first page as the response to a slash command
+    async def respond(self, interaction):
+        await interaction.response.send_message(self.render(), view=self)
+        self.message = await interaction.original_response()
 
 
 # This function is used to search for movies in the logger (by searching the movie-log.txt file)
@@ -58,43 +1852,19 @@ def search_movies(query, search_by="movie_name"):
         return "The search criteria cannot be an empty string."
 
     # Check if the search criteria is valid
-    if search_by not in ["movie_name", "year", "director", "description", "genre"]:
+    if search_by not in SEARCH_FIELDS:
         return "Invalid search criteria. Please choose from 'movie_name', 'year', 'director', 'description', or 'genre'."
 
-    try:
-        # Open the json file in read mode
-        with open("movies.json", "r") as json_file:
-            # Load the data from the json file
-            data = json.load(json_file)
-    except FileNotFoundError:
-        return []
-    else:
-        # Iterate over each movie in the json data
-        for movie in data["movies"]:
-            # Check if the query matches the movie's title
-            if search_by == "movie_name":
-                if query.lower() in movie["movie_name"].lower():
-                    search_results.append(f"{movie['movie_name']}(UID: {movie['id']})")
-            # Check if the query matches the movie's year
-            elif search_by == "year":
-                if query.lower() in movie["year"].lower():
-                    search_results.append(
-                        f"{movie['movie_name']} - {movie['year']}")
-            # Check if the query matches the movie's director
-            elif search_by == "director":
-                if query.lower() in movie["director"].lower():
-                    search_results.append(
-                        f"{movie['movie_name']} - {movie['director']}")
-            # Check if the query matches the movie's description
-            elif search_by == "description":
-                if query.lower() in movie["description"].lower():
-                    search_results.append(
-                        f"{movie['movie_name']} - {movie['description']}")
-            # Check if the query matches the movie's genre
-            elif search_by == "genre":
-                if query.lower() in movie["genre"].lower():
-                    search_results.append(
-                        f"{movie['movie_name']} - {movie['genre']}")
+    # Iterate over each movie that matches the query
+    with metrics.time("index", "search"):
+        movies = store.search(query, search_by)
+    for movie in movies:
+        # Show the title with the field that was searched
+        if search_by == "movie_name":
+            search_results.append(f"{movie.movie_name}(UID: {movie.id})")
+        else:
+            search_results.append(
+                f"{movie.movie_name} - {field_text(movie, search_by)}")
 
     # if no movies are found, return "No movies found"
     if not search_results:
@@ -102,204 +1872,724 @@ def search_movies(query, search_by="movie_name"):
     # otherwise, return the search results
     return search_results
 
-# This function is used to add a movie to the logger (by appending to the movie-log.txt file)
+# This class is used to keep the completions OpenAI gave for movie titles on disk, so adding a
+# movie that was looked up before does not need a new request. The oldest entries are removed
+# once the cache is full, and entries expire after max_age seconds
+
+
+class CompletionCache:
+    def __init__(self, path="completion_cache.json", max_entries=5000, max_age=30 * 24 * 3600, save_delay=5.0):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.save_delay = save_delay
+        self.hits = 0
+        self.misses = 0
+        # Seconds of OpenAI requests that were saved by hits
+        self.saved_seconds = 0.0
+        self._lock = threading.Lock()
+        self._save_timer = None
+        # Key -> {"completion": text, "created": timestamp, "seconds": request duration}, least recently used first
+        self.entries = OrderedDict()
+        try:
+            with open(self.path, "r") as json_file:
+                self.entries.update(json.load(json_file))
+        except FileNotFoundError:
+            pass
+        except json.decoder.JSONDecodeError as e:
+            print(f"Ignoring damaged completion cache {self.path}: {e}")
+
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry["created"] > self.max_age:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            self.saved_seconds += entry["seconds"]
+            return entry["completion"]
+
+    def put(self, key, completion, seconds):
+        with self._lock:
+            self.entries[key] = {"completion": completion, "created": time.time(), "seconds": seconds}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            if self._save_timer is None:
+                self._save_timer = threading.Timer(self.save_delay, self.flush)
+                self._save_timer.daemon = True
+                self._save_timer.start()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        return (f"Completion cache: {len(self.entries)} entries, {self.hits} hits, {self.misses} misses "
+                f"({hit_rate:.0%} hit rate), {self.saved_seconds:.1f}s of OpenAI requests saved")
+
+    def flush(self):
+        with self._lock:
+            if self._save_timer is None:
+                return
+            self._save_timer.cancel()
+            self._save_timer = None
+            data = json.dumps(self.entries)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as json_file:
+            json_file.write(data)
+        os.replace(tmp_path, self.path)
+
+
+# Change this whenever the prompt changes, so completions for the old prompt are not reused
+PROMPT_VERSION = 2
+
+# Set the model to use for completion
+COMPLETION_MODEL = "text-davinci-003"
+
+# Set the temperature (controls the creativity of the completions)
+COMPLETION_TEMPERATURE = 0.5
+
+# The answer for one movie is five short lines (about 100 tokens), so this many tokens are
+# allowed per movie, leaving room for a long title or description
+MOVIE_COMPLETION_TOKENS = 160
+
+# When many movies are added at once, this many are asked about in one request
+BATCH_SIZE = 8
+
+# The format the details of a movie are asked in (and read back in by parse_movie_completion)
+COMPLETION_FORMAT = ("Answer with exactly these five lines and nothing else:\n"
+                     "Movie Name: <full title>\n"
+                     "Year: <year of release>\n"
+                     "Director: <director>\n"
+                     "Description: <one sentence, at most 40 words>\n"
+                     "Genre: <genres, separated by commas>")
+
+completion_cache = CompletionCache(
+    os.getenv("COMPLETION_CACHE", "completion_cache.json"),
+    max_entries=int(os.getenv("COMPLETION_CACHE_SIZE", 5000)),
+    max_age=float(os.getenv("COMPLETION_CACHE_DAYS", 30)) * 24 * 3600)
+atexit.register(completion_cache.flush)
+
+# This class is used to limit how fast something can be used: it refills at rate units per
+# second up to capacity, and acquire() waits until enough units are available
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount):
+        amount = min(amount, self.capacity)
+        while True:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def release(self, amount):
+        # Give back units that were acquired but not used
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def empty(self):
+        self._refill()
+        self.tokens = 0
+
+
+# Priorities of OpenAI requests (lower numbers are sent first)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+PRIORITY_BACKGROUND = 2
+
+# This class is used to send all the OpenAI requests. Requests wait in a priority queue and a
+# fixed number of workers send them, within the requests-per-minute and tokens-per-minute quota.
+# Requests that fail with a temporary error are retried with jittered exponential backoff
+
+
+class OpenAIScheduler:
+    # The errors that are worth retrying (a property, so openai is only imported once a request is sent)
+    @property
+    def retryable_errors(self):
+        return (openai.error.RateLimitError, openai.error.Timeout, openai.error.APIConnectionError,
+                openai.error.ServiceUnavailableError, openai.error.TryAgain)
+
+    def __init__(self, concurrency=4, requests_per_minute=60, tokens_per_minute=150000,
+                 max_retries=5, base_delay=1.0, max_delay=60.0):
+        self.concurrency = concurrency
+        self.requests = TokenBucket(requests_per_minute / 60, requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute / 60, tokens_per_minute)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.queue = asyncio.PriorityQueue()
+        self._order = itertools.count()
+        self._workers = []
+        # Counters for the >openai command
+        self.active = 0
+        self.max_queue_depth = 0
+        self.sent = 0
+        self.completed = 0
+        self.failed = 0
+        self.retries = 0
+
+    async def submit(self, priority, **request):
+        # The workers are started by the first request, once the event loop is running
+        if not self._workers:
+            self._workers = [asyncio.ensure_future(self._work()) for _ in range(self.concurrency)]
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((priority, next(self._order), time.perf_counter(), request, future))
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return await future
+
+    async def _work(self):
+        while True:
+            _, _, submitted, request, future = await self.queue.get()
+            if future.cancelled():
+                continue
+            metrics.observe("openai", "queue_wait", time.perf_counter() - submitted)
+            self.active += 1
+            try:
+                result = await self._send(request)
+            except Exception as e:
+                self.failed += 1
+                if not future.cancelled():
+                    future.set_exception(e)
+            else:
+                self.completed += 1
+                if not future.cancelled():
+                    future.set_result(result)
+            finally:
+                self.active -= 1
+
+    async def _send(self, request):
+        # Estimate the tokens of the request (about 4 characters per token) plus its answer
+        estimated_tokens = len(request["prompt"]) // 4 + request["max_tokens"]
+        for attempt in range(self.max_retries + 1):
+            with metrics.time("openai", "rate_limit_wait"):
+                await self.requests.acquire(1)
+                await self.tokens.acquire(estimated_tokens)
+            self.sent += 1
+            try:
+                with metrics.time("openai", "request"):
+                    completions = await openai.Completion.acreate(**request)
+            except self.retryable_errors as e:
+                if attempt == self.max_retries:
+                    raise
+                if isinstance(e, openai.error.RateLimitError):
+                    # Slow every worker down, not just this one
+                    self.requests.empty()
+                self.retries += 1
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                print(f"OpenAI API request failed ({e}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+            else:
+                # Give back the tokens that were estimated but not used
+                usage = getattr(completions, "usage", None)
+                if usage is not None:
+                    self.tokens.release(max(0, estimated_tokens - usage.total_tokens))
+                return completions
 
+    def stats(self):
+        return (f"OpenAI requests: {self.queue.qsize()} queued (at most {self.max_queue_depth}), "
+                f"{self.active} running, {self.completed} completed, {self.failed} failed, "
+                f"{self.sent} sent, {self.retries} retries")
 
-def add_movie(movie_name):
-    # Check if the movie name is empty
-    if not movie_name:
-        return "The movie name cannot be an empty string."
-    # Check if the movie already exists in the logger
-    if movie_name in get_movie_list():
-        return "The movie already exists in the logger."
+
+openai_scheduler = OpenAIScheduler(
+    concurrency=int(os.getenv("OPENAI_CONCURRENCY", 4)),
+    requests_per_minute=int(os.getenv("OPENAI_REQUESTS_PER_MINUTE", 60)),
+    tokens_per_minute=int(os.getenv("OPENAI_TOKENS_PER_MINUTE", 150000)))
+
+# This function is used to get a completion from OpenAI without blocking the bot while it waits
+
+
+async def request_completion(prompt, model, max_tokens, temperature, priority=PRIORITY_INTERACTIVE):
+    completions = await openai_scheduler.submit(
+        priority, engine=model, prompt=prompt, max_tokens=max_tokens, n=1, temperature=temperature, format="text"
+    )
+    # Get the first completion
+    return completions.choices[0].text
+
+
+# This function is used to get the OpenAI completion with the details of a movie, from the
+# completion cache if the same title was looked up before
 
 
+async def fetch_movie_completion(movie_name, priority=PRIORITY_INTERACTIVE):
     # Set the prompt
-    prompt = (f"Information about the movie {movie_name}\n"
-              "Include the movie name, year, director, short description, and genre.")
+    prompt = f"Information about the movie {movie_name}\n{COMPLETION_FORMAT}"
 
-    # Set the model to use for completion
-    model = "text-davinci-003"
+    completion = completion_cache.get(completion_cache_key(movie_name))
+    if completion is not None:
+        return completion
 
-    # Set the number of completions to generate
-    num_completions = 1
+    # Generate the completion (other commands keep running while it is generated)
+    started = time.perf_counter()
+    completion = await request_completion(
+        prompt, COMPLETION_MODEL, MOVIE_COMPLETION_TOKENS, COMPLETION_TEMPERATURE, priority=priority)
+    # Refusals and answers in the wrong format are not cached, so the next add asks again
+    if parse_movie_completion(completion) is not None:
+        completion_cache.put(completion_cache_key(movie_name), completion, time.perf_counter() - started)
+    return completion
 
-    # Set the temperature (controls the creativity of the completions)
-    temperature = 0.5
 
-    try:
-        # Generate completions
-        completions = openai.Completion.create(
-            engine=model, prompt=prompt, max_tokens=2048, n=num_completions, temperature=temperature, format="text"
-        )
-    except openai.error.Timeout as e:
-        # Handle timeout error, e.g. retry or log
-        print(f"OpenAI API request timed out: {e}")
-        pass
-    except openai.error.APIError as e:
-        # Handle API error, e.g. retry or log
-        print(f"OpenAI API returned an API Error: {e}")
-        pass
-    except openai.error.APIConnectionError as e:
-        # Handle connection error, e.g. check network or log
-        print(f"OpenAI API request failed to connect: {e}")
-        pass
-    except openai.error.InvalidRequestError as e:
-        # Handle invalid request error, e.g. validate parameters or log
-        print(f"OpenAI API request was invalid: {e}")
-        pass
-    except openai.error.AuthenticationError as e:
-        # Handle authentication error, e.g. check credentials or log
-        print(f"OpenAI API request was not authorized: {e}")
-        pass
-    except openai.error.PermissionError as e:
-        #Handle permission error, e.g. check scope or log
-        print(f"OpenAI API request was not permitted: {e}")
-        pass
-    except openai.error.RateLimitError as e:
-        #Handle rate limit error, e.g. wait or log
-        print(f"OpenAI API request exceeded rate limit: {e}")
-        pass
+# This function is used to get the OpenAI completions for several movies with one request.
+# Returns one completion per movie, or None if the answer could not be split into one part per movie
 
 
-    # Get the first completion
-    completion = completions.choices[0].text
+async def fetch_movie_completions(movie_names):
+    # Set the prompt
+    titles = "\n".join(f"{i}. {movie_name}" for i, movie_name in enumerate(movie_names, 1))
+    prompt = (f"Information about each of these movies:\n{titles}\n"
+              f"For each movie, in the same order: {COMPLETION_FORMAT}\n"
+              "Put a line with only --- between the movies.")
+
+    started = time.perf_counter()
+    completion = await request_completion(
+        prompt, COMPLETION_MODEL, MOVIE_COMPLETION_TOKENS * len(movie_names), COMPLETION_TEMPERATURE,
+        priority=PRIORITY_BATCH)
+    seconds = (time.perf_counter() - started) / len(movie_names)
+
+    completions = [part.strip() for part in re.split(r"^\s*---\s*$", completion, flags=re.MULTILINE)]
+    completions = [part for part in completions if part]
+    if len(completions) != len(movie_names):
+        return None
+    # Cache every movie on its own, so a later >add of one of them can use it (unless it cannot be read)
+    for movie_name, movie_completion in zip(movie_names, completions):
+        if parse_movie_completion(movie_completion) is not None:
+            completion_cache.put(completion_cache_key(movie_name), movie_completion, seconds)
+    return completions
 
-    print(completion)
-    
-    # Extract the movie name, year, director, description, and genre from the completion
-    movie_name = re.search("Movie Name:(.*)", completion).group(1).strip()
-    year = re.search("Year:(.*)", completion).group(1).strip()
-    director = re.search("Director:(.*)", completion).group(1).strip()
-    description = re.search(
-        "Description:(.*)", completion, re.DOTALL).group(1).strip()
-    genre_list = re.search("Genre:(.*)", completion).group(1).strip()
-    genre = genre_list.split(", ")
-    
+
+# This function is used to get the key of a movie title in the completion cache
+
+
+def completion_cache_key(movie_name):
+    return f"{PROMPT_VERSION}:{COMPLETION_MODEL}:{normalize_title(movie_name)}"
+
+
+# Matches the five lines of COMPLETION_FORMAT in one pass (the description may go on over
+# several lines, up to the Genre line)
+MOVIE_COMPLETION = re.compile(r"^[ \t]*Movie Name:(.*)\n[ \t]*Year:(.*)\n[ \t]*Director:(.*)\n"
+                              r"[ \t]*Description:((?s:.*?))\n[ \t]*Genre:(.*)", re.MULTILINE)
+
+# This class is used to report an OpenAI completion that is not in the expected format
+
+
+class CompletionFormatError(Exception):
+    pass
+
+
+# This function is used to read the movie details from an OpenAI completion.
+# Returns a new movie object, or None if the completion is not in the expected format
+
+
+def parse_movie_completion(completion):
+    match = MOVIE_COMPLETION.search(completion)
+    if match is None:
+        return None
+    movie_name, year, director, description, genre_list = match.groups()
+    movie_name = movie_name.strip()
+    if not movie_name:
+        return None
 
     # Create a new movie object
-    movie = {
-        "id": uuid.uuid4().hex,
-        "movie_name": movie_name,
-        "year": year,
-        "director": director,
-        "description": description,
-        "genre": genre
-    }
+    return Movie(
+        uuid.uuid4().hex,
+        movie_name,
+        year.strip(),
+        director.strip(),
+        " ".join(description.split()),
+        [genre.strip() for genre in genre_list.split(",") if genre.strip()]
+    )
 
-    # open the json file in read mode
-    with open("movies.json", "r") as json_file:
-        # load the data from the json file
-        data = json.load(json_file)
-    # append the new movie to the array of movies
-    data["movies"].append(movie)
-    # open the json file in write mode
-    with open("movies.json", "w") as json_file:
-        # write the updated data to the json file
-        json.dump(data, json_file)
+
+# Normalized title -> future with the result of the >add that is adding that movie (so an add of
+# a title that is already being added waits for that add instead of asking OpenAI again)
+adds_in_progress = {}
+
+# This function is used to check if a movie can be added to the logger.
+# Returns the reason if it cannot be added, or None
+
+
+def check_new_movie(movie_name, force=False):
+    # Check if the movie name is empty
+    if not movie_name:
+        return "The movie name cannot be an empty string."
+    # Check if the movie already exists in the logger
+    with metrics.time("index", "find_by_name"):
+        existing = store.find_by_name(movie_name)
+    if existing is not None:
+        return "The movie already exists in the logger."
+    # Check if a movie with a very similar title exists before asking OpenAI about it
+    if not force:
+        # Short titles only allow fewer edits, so "Up" is not a duplicate of "Us"
+        max_distance = min(DUPLICATE_DISTANCE, len(normalize_title(movie_name)) // 6)
+        # Titles with different numbers are sequels, not duplicates ("Part II" and "Part III")
+        numbers = re.findall(r"\d+", normalize_title(movie_name))
+        with metrics.time("index", "similar_titles"):
+            similar_movies = store.similar_titles(movie_name, max_distance)
+        similar_movies = [movie for movie in similar_movies
+                          if re.findall(r"\d+", normalize_title(movie.movie_name)) == numbers]
+        if similar_movies:
+            names = ", ".join(f"'{movie.movie_name}'" for movie in similar_movies[:5])
+            return (f"A similar movie is already in the logger: {names}. "
+                    f"Use >add --force {movie_name} to add it anyway.")
+    return None
+
+
+# This function is used to add a movie with all its details to the store
+
+
+def save_new_movie(movie):
+    movie_name = movie.movie_name
+
+    # Another >add may have added the same movie while this one was waiting for OpenAI
+    if store.find_by_name(movie_name) is not None:
+        return "The movie already exists in the logger."
+
+    # append the new movie to the store (it is saved to movies.json in the background)
+    store.add(movie)
 
 
     # Print a message to confirm that the movie was added
     print(f"Movie '{movie_name}' was added to the database.")
+    return f"Movie '{movie_name}' was added to the database."
+
+
+# This function is used to add many movies at once. The movies that are not in the local IMDb
+# index or the completion cache are asked about in groups of BATCH_SIZE (the groups run in parallel), and all the new
+# movies are saved to the store together. Returns a list of (movie name, result message)
+
+
+async def add_movies(movie_names, force=False):
+    results = [[movie_name, None] for movie_name in movie_names]
+    completions = {}
+    # Movie name -> movie found in the local IMDb index
+    found = {}
+    to_fetch = []
+    waiting = []
+    # Normalized title -> result of the movies this add is adding
+    adding = {}
+    seen = set()
+    for result in results:
+        movie_name = result[0]
+        key = normalize_title(movie_name)
+        problem = check_new_movie(movie_name, force)
+        if problem:
+            result[1] = problem
+        elif key in seen:
+            result[1] = "The movie is listed more than once."
+        elif key in adds_in_progress:
+            # Another >add is already adding this movie
+            waiting.append((result, adds_in_progress[key]))
+        else:
+            movie = movie_reference.lookup(movie_name)
+            completion = None if movie else completion_cache.get(completion_cache_key(movie_name))
+            if movie is not None:
+                found[movie_name] = movie
+            elif completion is not None:
+                completions[movie_name] = completion
+            else:
+                to_fetch.append(movie_name)
+            # Other adds of this title wait for this one
+            adds_in_progress[key] = asyncio.get_running_loop().create_future()
+            adding[key] = result
+        seen.add(key)
+
+    try:
+        # Ask OpenAI about the remaining movies, BATCH_SIZE movies per request
+        groups = [to_fetch[i:i + BATCH_SIZE] for i in range(0, len(to_fetch), BATCH_SIZE)]
+        group_completions = await asyncio.gather(
+            *[fetch_movie_completions(group) for group in groups], return_exceptions=True)
+        for group, group_completion in zip(groups, group_completions):
+            if isinstance(group_completion, openai.error.OpenAIError):
+                print(f"OpenAI API request failed: {group_completion}")
+                for movie_name in group:
+                    completions[movie_name] = group_completion
+            elif isinstance(group_completion, BaseException):
+                raise group_completion
+            elif group_completion is None:
+                # The answer could not be split per movie, so ask about each movie on its own
+                single_completions = await asyncio.gather(
+                    *[fetch_movie_completion(movie_name) for movie_name in group], return_exceptions=True)
+                completions.update(zip(group, single_completions))
+            else:
+                completions.update(zip(group, group_completion))
+
+        # Read the movie details and save all the new movies in one write
+        new_movies = []
+        new_names = set()
+        for result in results:
+            completion = completions.get(result[0])
+            if result[0] in found:
+                movie = found[result[0]]
+            elif completion is None:
+                continue
+            elif isinstance(completion, BaseException):
+                result[1] = handle_error(completion)
+                continue
+            else:
+                movie = parse_movie_completion(completion)
+            if movie is None:
+                result[1] = "Could not read the movie details from OpenAI."
+            elif store.find_by_name(movie.movie_name) is not None or fold(movie.movie_name) in new_names:
+                result[1] = "The movie already exists in the logger."
+            else:
+                new_movies.append(movie)
+                new_names.add(fold(movie.movie_name))
+                result[1] = f"Movie '{movie.movie_name}' was added to the database."
+        if new_movies:
+            store.add_many(new_movies)
+            print(f"{len(new_movies)} movies were added to the database.")
+    finally:
+        # Let the adds that were waiting for these movies know how it went
+        for key, result in adding.items():
+            adds_in_progress.pop(key).set_result(result[1] or "The movie could not be added.")
+
+    for result, future in waiting:
+        result[1] = await asyncio.shield(future)
+    return [tuple(result) for result in results]
+
+
+# This class is used to fill in the details of movies in the background. Every job is written to
+# an append-only file (one JSON record per line) before it runs and marked as done when it
+# finishes, so jobs that were still waiting when the bot stopped are run again after a restart
+
+
+class EnrichmentQueue:
+    def __init__(self, path="enrichment_queue.jsonl", workers=2, max_attempts=3, retry_delay=60.0):
+        self.path = path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        # Job ID -> job, for the jobs that are not done yet
+        self.pending = OrderedDict()
+        self.done = 0
+        self.failed = 0
+        self._queue = asyncio.Queue()
+        self._tasks = []
+        # The file is read (and then appended to) by start, so importing the module writes nothing
+        self._file = None
+
+    def _load(self):
+        try:
+            queue_file = open(self.path, "r")
+        except FileNotFoundError:
+            return
+        with queue_file:
+            for line in queue_file:
+                try:
+                    record = json.loads(line)
+                except json.decoder.JSONDecodeError:
+                    continue
+                if record["op"] == "enqueue":
+                    self.pending[record["job"]["id"]] = record["job"]
+                elif record["op"] == "done":
+                    self.pending.pop(record["id"], None)
+        for job in self.pending.values():
+            self._queue.put_nowait(job)
+        # Start a new file with only the jobs that are still waiting
+        self._rewrite()
+
+    def _rewrite(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as queue_file:
+            for job in self.pending.values():
+                queue_file.write(json.dumps({"op": "enqueue", "job": job}) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def _append(self, record):
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def enqueue(self, movie):
+        job = {"id": uuid.uuid4().hex, "movie_id": movie.id, "movie_name": movie.movie_name}
+        self._append({"op": "enqueue", "job": job})
+        self.pending[job["id"]] = job
+        self._queue.put_nowait(job)
+
+    def start(self):
+        if self._file is None:
+            self._load()
+            self._file = open(self.path, "a")
+        # The workers are started once the event loop is running
+        if not self._tasks:
+            self._tasks = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+
+    async def _work(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await fill_in_movie(job)
+            except (openai.error.OpenAIError, CompletionFormatError) as e:
+                attempts = job.get("attempts", 0) + 1
+                if attempts < self.max_attempts:
+                    print(f"Could not get the details of '{job['movie_name']}' ({e}), trying again later")
+                    job["attempts"] = attempts
+                    asyncio.get_running_loop().call_later(self.retry_delay, self._queue.put_nowait, job)
+                    continue
+                print(f"Giving up on the details of '{job['movie_name']}': {e}")
+                self.failed += 1
+            except Exception as e:
+                import logging
+                logging.exception(e)
+                self.failed += 1
+            self._finish(job)
+
+    def _finish(self, job):
+        self._append({"op": "done", "id": job["id"]})
+        del self.pending[job["id"]]
+        self.done += 1
+        # Start a new file once every job is done, so it does not keep growing
+        if not self.pending:
+            self._file.close()
+            self._rewrite()
+            self._file = open(self.path, "a")
+
+    def stats(self):
+        return (f"Enrichment queue: {len(self.pending)} waiting, {self.done} done, {self.failed} failed, "
+                f"{self.workers} workers")
+
+
+enrichment_queue = EnrichmentQueue(
+    os.getenv("ENRICHMENT_QUEUE", "enrichment_queue.jsonl"),
+    workers=int(os.getenv("ENRICHMENT_WORKERS", 2)))
+
+# This function is used to add a movie to the logger right away with only its name, and to
+# queue a background job that fills in its details from OpenAI
+
+
+def queue_movie(movie_name, force=False):
+    problem = check_new_movie(movie_name, force)
+    if problem:
+        return problem
+    if normalize_title(movie_name) in adds_in_progress:
+        return "The movie is already being added."
+
+    # Well-known movies are added with their details from the local IMDb index straight away
+    movie = movie_reference.lookup(movie_name)
+    if movie is not None:
+        return save_new_movie(movie)
+
+    # Create a placeholder movie object (the details are filled in by fill_in_movie)
+    movie = Movie(uuid.uuid4().hex, movie_name)
+    store.add(movie)
+    enrichment_queue.enqueue(movie)
+    return f"Movie '{movie_name}' was added to the database. Its details will be filled in shortly."
+
+
+# This function is used to fill in the details of a placeholder movie from OpenAI
+
+
+async def fill_in_movie(job):
+    movie = store.get(job["movie_id"])
+    # The movie was deleted while the job was waiting
+    if movie is None:
+        return
+
+    completion = await fetch_movie_completion(job["movie_name"], priority=PRIORITY_BACKGROUND)
+    details = parse_movie_completion(completion)
+    if details is None:
+        # The answer is not cached, so the job asks OpenAI again when it is retried
+        raise CompletionFormatError("the answer from OpenAI could not be read")
+
+    # Fields that were changed with >update in the meantime are kept
+    movie = store.get(job["movie_id"])
+    if movie is None:
+        return
+    for field in ("year", "director", "description", "genre"):
+        if not getattr(movie, field):
+            store.update(movie, field, getattr(details, field))
+    # Use the full title from OpenAI unless another movie already has it
+    # (compared by ID, the SQLite store returns a new Movie for every lookup)
+    existing = store.find_by_name(details.movie_name)
+    if movie.movie_name == job["movie_name"] and (existing is None or existing.id == movie.id):
+        store.update(movie, "movie_name", details.movie_name)
+    print(f"Details of movie '{movie.movie_name}' were filled in.")
+
+
+# This function is used to find a movie by its ID (UID) or by its name
+
+
+def find_movie(movie_name_or_ID):
+    with metrics.time("index", "find_movie"):
+        movie = store.get(movie_name_or_ID)
+        if movie is None:
+            movie = store.find_by_name(movie_name_or_ID)
+    return movie
 
 
 # This function is used to delete a movie from the logger (by overwriting the movie-log.txt file)
 
 
 def delete_movie(movie_name_or_ID):
-    # Open the movies.json file in read mode
-    try:
-        with open("movies.json", "r") as movie_log_file:
-            movie_data = json.load(movie_log_file)
-    except FileNotFoundError:
-        return "movies.json file not found"
-    except json.decoder.JSONDecodeError as e:
-        return f"Error reading json file: {e}"
-
     # Check if the movie name or ID is empty
     if not movie_name_or_ID:
         return "The movie name or ID cannot be an empty string."
 
-    # Find the movie to delete
-    movie_to_delete = None
-    for movie in movie_data:
-        if movie_name_or_ID in (movie["movie_name"], movie["uniqueID"]):
-            movie_to_delete = movie
-            break
-    else:
+    # Find the movie to delete by its ID or its name
+    movie_to_delete = find_movie(movie_name_or_ID)
+    if movie_to_delete is None:
         return "Movie not found"
 
-    # Remove the movie from the movie_data list
-    movie_data.remove(movie_to_delete)
-    # Open the movies.json file in write mode and write the updated movie_data list
-    try:
-        with open("movies.json", "w") as movie_log_file:
-            json.dump(movie_data, movie_log_file)
-    except Exception as e:
-        return f"An error occurred: {e}"
+    # Remove the movie from the store (it is saved to movies.json in the background)
+    store.delete(movie_to_delete)
 
 
 # This function is used to update a movie in the logger (by overwriting the movie-log.txt file)
 
 
 def update_movie(movie_name, field_to_update, new_value):
-    try:
-        # Open the json file in read mode
-        with open("movies.json", "r") as json_file:
-            # Load the data from the json file
-            data = json.load(json_file)
-    except FileNotFoundError:
-        return "movies.json file not found"
-    else:
-        # Iterate over each movie in the json data
-        for movie in data["movies"]:
-            if movie["movie_name"].lower() == movie_name.lower():
-                movie[field_to_update] = new_value
-                break
-        else:
-            return f"Movie with name '{movie_name}' not found."
-    # Open the json file in write mode
-    with open("movies.json", "w") as json_file:
-        # Write the updated data to the json file
-        json.dump(data, json_file)
+    result = update_movie_fields(movie_name, {field_to_update: new_value})
+    if result != "Movie updated successfully":
+        return result
     return f"{field_to_update} of movie '{movie_name}' is updated to '{new_value}'"
 
 
+# This function is used to update several fields of a movie at once ({field: new value}). The movie
+# is looked up once, so renaming it does not lose the fields after the name, and every field is
+# checked before any is changed
 
-# This function is used to sort the movies in the logger based on the specified criteria
 
+def update_movie_fields(movie_name, updates):
+    # Look up the movie by its ID or its name (case-insensitive)
+    movie = find_movie(movie_name)
+    if movie is None:
+        return "Movie not found"
+    # Movies only have these fields (the UID cannot be changed)
+    if any(field not in SEARCH_FIELDS for field in updates):
+        return "Invalid field. Please choose from 'movie_name', 'year', 'director', 'description', or 'genre'."
+    for field, new_value in updates.items():
+        # The genre is stored as a list of genres
+        if field == "genre" and isinstance(new_value, str):
+            new_value = new_value.split(", ")
+        store.update(movie, field, new_value)
+    return "Movie updated successfully"
 
-def sort_movies(sort_by):
-    # Read the movies from the json file and store them in a list
-    try:
-        with open("movies.json", "r") as json_file:
-            data = json.load(json_file)
-            movies = data["movies"]
-    except FileNotFoundError:
-        return "movies.json file not found"
-    except Exception as e:
-        return f"An error occurred: {e}"
-
-    # Sort the list of movies based on the specified criteria
-    if sort_by == "movie_name":
-        sorted_movies = sorted(movies, key=lambda movie: movie["movie_name"])
-        sorted_movies = [
-            f"{movie['movie_name']} (UID: {movie['id']})" for movie in sorted_movies]
-    elif sort_by == "year":
-        sorted_movies = sorted(movies, key=lambda movie: movie["year"])
-        sorted_movies = ["-".join([movie["movie_name"], movie["year"]])
-                         for movie in sorted_movies]
-    elif sort_by == "genre":
-        sorted_movies = sorted(movies, key=lambda movie: movie["genre"])
-        sorted_movies = ["-".join([movie["movie_name"], movie["genre"]])
-                         for movie in sorted_movies]
-    else:
-        return "Invalid criteria. Please choose from 'movie_name', 'year', or 'genre'."
 
-    return "\n".join(sorted_movies)
+# This function is used to sort the movies in the logger based on the specified criteria
 
 
+def sort_movies(sort_by, page=0):
+    if sort_by not in SORT_FIELDS:
+        return "Invalid criteria. Please choose from 'movie_name', 'year', 'genre', 'director', or 'added'."
 
+    # Get one page of the movies sorted by the specified criteria
+    return render_movie_page(sort_by, page)
 
 
 # This function is used to handle errors
@@ -312,15 +2602,294 @@ def handle_error(error):
         return "Unable to create error message"
 
 
-# Debug intents
-debug_guild = int(os.getenv("DEBUG_GUILD"))
-debug_channel = int(os.getenv("DEBUG_CHANNEL"))
+# Debug intents (None when they are not set)
+debug_guild = int(os.getenv("DEBUG_GUILD")) if os.getenv("DEBUG_GUILD") else None
+debug_channel = int(os.getenv("DEBUG_CHANNEL")) if os.getenv("DEBUG_CHANNEL") else None
+
+# This class is used to find out when something blocks the event loop. A task on the loop wakes up
+# every interval and records how late it woke up (the loop lag). A watchdog thread checks that the
+# task keeps waking up; if it is late by more than threshold, the thread takes the stack of the loop
+# thread, so the stall can be traced to the command and the call that was blocking
+
+
+class LoopWatchdog:
+    def __init__(self, threshold=0.2, interval=0.1, max_stalls=20):
+        self.threshold = threshold
+        self.interval = interval
+        # The latest stalls: {"time", "seconds", "command", "stack"}
+        self.stalls = deque(maxlen=max_stalls)
+        self.stall_count = 0
+        self.loop = None
+        self._loop_thread = None
+        self._last_beat = None
+        # The stall the watchdog thread caught, until the loop is running again
+        self._pending = None
+        self._command_codes = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self.loop is not None:
+            return
+        self.loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        # Code of each command's callback -> command name, to find the command in a stack
+        self._command_codes = {command.callback.__code__: f">{command.name}" for command in bot.commands}
+        self._command_codes.update(
+            {command.callback.__code__: f"/{command.name}" for command in bot.tree.get_commands()})
+        self._last_beat = time.monotonic()
+        asyncio.ensure_future(self._beat())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    async def _beat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            metrics.observe("loop", "lag", lag)
+            with self._lock:
+                self._last_beat = now
+                stall, self._pending = self._pending, None
+            if stall is None and lag >= self.threshold:
+                # Too short for the watchdog thread to see it, so there is no stack
+                stall = {"time": time.time() - lag, "command": None, "stack": []}
+            if stall is not None:
+                stall["seconds"] = lag
+                self.stalls.append(stall)
+                self.stall_count += 1
+                print(f"Event loop blocked for {lag * 1000:.0f} ms in {stall['command'] or 'no command'}"
+                      + "".join(f"\n    {line}" for line in stall["stack"]))
+
+    def _watch(self):
+        while True:
+            time.sleep(self.interval / 2)
+            with self._lock:
+                blocked = time.monotonic() - self._last_beat - self.interval
+                if blocked < self.threshold or self._pending is not None:
+                    continue
+                frame = sys._current_frames().get(self._loop_thread)
+                self._pending = {"time": time.time() - blocked, "command": self._find_command(frame),
+                                 "stack": self._summarize(frame)}
+
+    def _find_command(self, frame):
+        while frame is not None:
+            command = self._command_codes.get(frame.f_code)
+            if command is not None:
+                return command
+            frame = frame.f_back
+        return None
+
+    def _summarize(self, frame):
+        # The frames of this file, and the innermost frame (where the loop thread actually is)
+        frames = traceback.extract_stack(frame)
+        lines = [f"{os.path.basename(entry.filename)}:{entry.lineno} in {entry.name}"
+                 for i, entry in enumerate(frames) if entry.filename == __file__ or i == len(frames) - 1]
+        return lines[-10:]
+
+    def report(self):
+        lag = metrics.histograms.get(("loop", "lag"))
+        if lag is None:
+            return "The loop watchdog is not running."
+        lines = [f"Loop lag: p50 {lag.quantile(0.5) * 1000:.1f} ms, p99 {lag.quantile(0.99) * 1000:.1f} ms, "
+                 f"max {lag.max * 1000:.1f} ms; {self.stall_count} stalls over {self.threshold * 1000:.0f} ms"]
+        for stall in list(self.stalls)[-5:]:
+            when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(stall["time"]))
+            lines.append(f"{when}: {stall['seconds'] * 1000:.0f} ms in {stall['command'] or 'no command'}")
+            lines.extend(f"    {line}" for line in stall["stack"])
+        return "\n".join(lines)
+
+
+loop_watchdog = LoopWatchdog(threshold=float(os.getenv("STALL_THRESHOLD_MS", 200)) / 1000)
+
+# This class is used to profile the running bot by sampling the stacks of all its threads every
+# interval seconds (so nothing is slowed down by tracing every call). The samples are written in the
+# collapsed-stack format ("outer;inner;innermost count" per line) that flamegraph tools read
+
+
+class SamplingProfiler:
+    def __init__(self, directory="profiles", interval=0.005, max_seconds=300):
+        self.directory = directory
+        self.interval = interval
+        self.max_seconds = max_seconds
+        # Held while a profile is taken, so only one is taken at a time
+        self.lock = asyncio.Lock()
+
+    def _sample(self, seconds):
+        me = threading.get_ident()
+        stacks = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+        return stacks
+
+    # Profiles for the given number of seconds (in a thread, so the bot keeps running) and returns
+    # the path of the collapsed-stack file and the functions of this file that were seen most often
+    async def profile(self, seconds):
+        stacks = await asyncio.get_running_loop().run_in_executor(None, self._sample, min(seconds, self.max_seconds))
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, time.strftime("profile-%Y%m%d-%H%M%S.collapsed"))
+        with open(path, "w") as profile_file:
+            for stack, count in stacks.most_common():
+                profile_file.write(f"{stack} {count}\n")
+        # Samples each function of this file was on the stack for (counted once per sample)
+        functions = Counter()
+        suffix = f" ({os.path.basename(__file__)})"
+        for stack, count in stacks.items():
+            for function in set(stack.split(";")):
+                if function.endswith(suffix):
+                    functions[function[:-len(suffix)]] += count
+        return path, sum(stacks.values()), functions.most_common(10)
+
+
+profiler = SamplingProfiler(os.getenv("PROFILE_DIR", "profiles"))
+
+# Where the metrics are served in the Prometheus text format (an empty port turns it off)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = os.getenv("METRICS_PORT", "9108")
+metrics_runner = None
+
+# This function is used to serve the metrics over HTTP (GET /metrics) for Prometheus to scrape
+
+
+async def start_metrics_server():
+    global metrics_runner
+    if metrics_runner is not None or not METRICS_PORT:
+        return
+
+    async def serve_metrics(request):
+        return web.Response(text=metrics.prometheus(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", serve_metrics)
+    metrics_runner = web.AppRunner(app)
+    await metrics_runner.setup()
+    await web.TCPSite(metrics_runner, METRICS_HOST, int(METRICS_PORT)).start()
+    print(f"Serving metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+
+# Time every > command (after_invoke runs even when the command fails)
+
+
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.command_started = time.perf_counter()
+
+
+@bot.after_invoke
+async def stop_command_timer(ctx):
+    metrics.observe("command", ctx.command.name, time.perf_counter() - ctx.command_started)
+
+
+# Time every slash command as well, under its name with a slash (on_app_command_completion runs when
+# it succeeds, MovieCommandTree.on_error when it fails)
+
+
+def stop_app_command_timer(interaction):
+    started = interaction.extras.pop("command_started", None)
+    # Autocomplete requests are not timed
+    if (started is not None and interaction.command is not None
+            and interaction.type == discord.InteractionType.application_command):
+        metrics.observe("command", f"/{interaction.command.qualified_name}", time.perf_counter() - started)
+
+
+@bot.event
+async def on_app_command_completion(interaction, command):
+    stop_app_command_timer(interaction)
+
+
+# This function is used to get the bot ready once it is connected: load the catalog (in a thread,
+# so the connection to Discord stays responsive), render the first pages, and only then let commands
+# through. The search indexes are built in the background after that (searches scan the catalog
+# until they are ready). The time of each startup phase is logged. Returns False if the catalog
+# could not be loaded
+
+
+async def start_up():
+    global store, catalog_error, index_build
+    end_startup_phase("connect to Discord")
+    # Started first, so a startup phase that blocks the event loop shows up as a stall
+    loop_watchdog.start()
+
+    # Commands wait again while a failed load is tried again
+    catalog_error = None
+    catalog_ready.clear()
+    try:
+        store = await asyncio.get_running_loop().run_in_executor(None, open_movie_store, True)
+    except Exception as e:
+        traceback.print_exc()
+        catalog_error = f"The movie catalog could not be loaded ({e}). Please try again later."
+        catalog_ready.set()
+        return False
+    # Make sure pending writes are saved on exit
+    atexit.register(store.flush)
+    end_startup_phase("load catalog")
+
+    for sort_by in SORT_FIELDS:
+        render_movie_page(sort_by, 0)
+    end_startup_phase("render first pages")
+    # Start working on the enrichment jobs (including the ones left from the last run), before any
+    # command can add a job
+    enrichment_queue.start()
+    catalog_ready.set()
+    index_build = asyncio.ensure_future(store.build_indexes())
+    index_build.add_done_callback(report_index_build)
+
+    # Register the slash commands with Discord
+    try:
+        synced = await bot.tree.sync()
+        print(f"Synced {len(synced)} slash commands")
+    except discord.HTTPException as e:
+        print(f"Could not sync the slash commands: {e}")
+    end_startup_phase("sync slash commands")
+
+    try:
+        await start_metrics_server()
+    except OSError as e:
+        print(f"Could not serve the metrics on port {METRICS_PORT}: {e}")
+    end_startup_phase("start background work")
+
+    print("Startup: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in startup_phases.items())
+          + f"; total {time.perf_counter() - startup_started:.2f}s")
+    return True
+
+
+# This function is used to report a build of the search indexes that failed (searches then keep
+# checking every movie)
+
+
+def report_index_build(task):
+    if task.cancelled() or task.exception() is None:
+        return
+    error = task.exception()
+    print(f"Could not build the search indexes, so every search checks every movie: {error}")
+    traceback.print_exception(type(error), error, error.__traceback__)
+
+
+# Whether start_up was run (it is run again on the next connect if the catalog could not be loaded)
+started_up = False
+# Task building the search indexes of the catalog
+index_build = None
 
 # Define the on_ready event handler
 
 
 @bot.event
 async def on_ready():
+    global started_up
+    # on_ready runs again after every reconnect, but the bot only needs to start up once
+    if not started_up:
+        started_up = True
+        started_up = await start_up()
     print("Bot is up and running...")
     # Set the bot's status
     await bot.change_presence(activity=discord.Game(name="/help for commands"))
@@ -332,11 +2901,9 @@ async def on_ready():
 @bot.command(name="movies")
 async def movies(ctx):
     try:
-        movie_list = get_movie_list()
+        await MoviePages("added").send(ctx)
     except FileNotFoundError:
         await ctx.send("movies.json file not found")
-    else:
-        await ctx.send(f"List of movies:\n{movie_list}")
 
 # Define the >search command
 
@@ -358,20 +2925,35 @@ async def search(ctx, *, query):
 
 
 @bot.command(name="add")
-async def add(ctx, *, movie_details):
+async def add(ctx, *, movie_details=""):
+    # Every line of an attached text file is a movie to add
+    for attachment in ctx.message.attachments:
+        movie_details += "\n" + (await attachment.read()).decode("utf-8", errors="replace")
+    movie_details = movie_details.strip()
     if not movie_details:
         await ctx.send("No movie details provided")
-        
-    # if movies.json exists
-    if os.path.exists("movies.json"):
-        add_movie_status = add_movie(movie_details)
-    # if movies.json does not exist, create it and add the movie
+        return
+
+    # "--force" skips the check for movies with similar titles
+    force = movie_details.startswith("--force")
+    if force:
+        movie_details = movie_details[len("--force"):].strip()
+
+    # Several lines add several movies at once
+    movie_names = [line.strip() for line in movie_details.splitlines() if line.strip()]
+
+    # The movie store creates movies.json on its first save if it does not exist
+    if len(movie_names) > 1:
+        async with ctx.typing():
+            results = await add_movies(movie_names, force=force)
+        add_movie_status = "\n".join(f"{movie_name}: {message}" for movie_name, message in results)
     else:
-        with open("movies.json", "w") as json_file:
-            json.dump({"movies": []}, json_file)
-        add_movie_status = add_movie(movie_details)
-        
-    await ctx.send(f"{add_movie_status}")
+        # The movie is added right away and its details are filled in in the background
+        add_movie_status = queue_movie(movie_details, force=force)
+
+    # Discord messages are limited to 2000 characters
+    for i in range(0, len(add_movie_status), 2000):
+        await ctx.send(add_movie_status[i:i + 2000])
     
 
 # Define the >delete command
@@ -404,8 +2986,8 @@ async def update(ctx, movie_name: str, *, update_str: str):
             key, value = update.split(": ")
             updates[key.lower()] = value
 
-        # Call the update_movie() function
-        result = update_movie(movie_name, **updates)
+        # Apply all the fields to the movie (or none of them if one is invalid)
+        result = update_movie_fields(movie_name, updates)
     except FileNotFoundError:
         await ctx.send("movies.json file not found")
     except Exception as e:
@@ -414,36 +2996,173 @@ async def update(ctx, movie_name: str, *, update_str: str):
         logging.exception(e)
         await ctx.send("An error occurred while updating the movie")
     else:
-        if result == "Movie not found":
-            await ctx.send("Movie not found")
-        else:
-            await ctx.send("Movie updated successfully")
+        await ctx.send(result)
+
+
+# Define the >cache command
+
+
+@bot.command(name="cache")
+async def cache(ctx):
+    await ctx.send(f"{completion_cache.stats()}\n{page_cache.stats()}")
+
+
+# Define the >openai command
+
+
+@bot.command(name="openai")
+async def openai_stats(ctx):
+    await ctx.send(f"{openai_scheduler.stats()}\n{enrichment_queue.stats()}\n{movie_reference.stats()}")
+
 
-            
 # Define the >sort command
 
 # change to use json!!!
 @bot.command(name="sort")
 async def sort(ctx, sort_by: str):
     # Validate the sort criteria
-    if sort_by not in ["movie_name", "year", "genre"]:
-        await ctx.send("Invalid sort criteria. Please choose from 'movie_name', 'year', or 'genre'")
+    if sort_by not in SORT_FIELDS:
+        await ctx.send("Invalid sort criteria. Please choose from 'movie_name', 'year', 'genre', 'director', or 'added'")
         return
 
-    # Call the sort_movies function
+    # Send the first page of the sorted movie list to the channel (the buttons show the others)
     try:
-        sorted_movies = sort_movies(sort_by)
+        await MoviePages(sort_by).send(ctx)
     except FileNotFoundError:
         await ctx.send("movies.json file not found")
     except Exception as e:
         await ctx.send("An error occurred while sorting the movies: {}".format(e))
+
+
+# Define the >stats command (for admins: the latency percentiles of the commands and of the work they do)
+
+
+@bot.command(name="stats")
+@commands.check_any(commands.is_owner(), commands.has_permissions(administrator=True))
+async def stats(ctx):
+    table = metrics.summary()
+    # Discord messages are limited to 2000 characters (minus the code block)
+    if len(table) > MESSAGE_LIMIT - 20:
+        table = table[:MESSAGE_LIMIT - 23] + "..."
+    await ctx.send(f"Latency in ms:\n```\n{table}\n```")
+
+
+# Define the >stalls command (for admins: the times the event loop was blocked, and by what)
+
+
+@bot.command(name="stalls")
+@commands.check_any(commands.is_owner(), commands.has_permissions(administrator=True))
+async def stalls(ctx):
+    report = loop_watchdog.report()
+    if len(report) > MESSAGE_LIMIT - 20:
+        report = report[:MESSAGE_LIMIT - 23] + "..."
+    await ctx.send(f"```\n{report}\n```")
+
+
+# Define the >profile command (for admins: profile the running bot for some seconds and send the
+# collapsed stacks, e.g. for flamegraph.pl or speedscope)
+
+
+@bot.command(name="profile")
+@commands.check_any(commands.is_owner(), commands.has_permissions(administrator=True))
+async def profile(ctx, seconds: int = 30):
+    # The lock is taken before the first await, so two >profile commands sent together cannot both start
+    if profiler.lock.locked():
+        await ctx.send("A profile is already being taken.")
         return
+    async with profiler.lock:
+        seconds = max(1, min(seconds, profiler.max_seconds))
+        await ctx.send(f"Profiling for {seconds} seconds...")
+        path, samples, functions = await profiler.profile(seconds)
+    lines = [f"{samples} stack samples written to {path}. Functions of the bot seen most often:"]
+    lines.extend(f"{count:>7}  {function}" for function, count in functions)
+    await ctx.send("```\n" + "\n".join(lines)[:MESSAGE_LIMIT - 8] + "\n```", file=discord.File(path))
+
+
+# This function is used to suggest movies while the movie option of a slash command is typed.
+# The title or UID typed so far is looked up by prefix in the store's sorted index, and the
+# suggestion's value is the UID of the movie
+
+
+async def movie_autocomplete(interaction, current):
+    with metrics.time("index", "complete"):
+        movies = store.complete(current.strip())
+    return [app_commands.Choice(name=f"{movie.movie_name[:60]} (UID: {movie.id})", value=movie.id)
+            for movie in movies]
+
+
+# This function is used to suggest movie titles while a search query is typed
+
+
+async def title_autocomplete(interaction, current):
+    with metrics.time("index", "complete"):
+        movies = store.complete(current.strip())
+    return [app_commands.Choice(name=movie.movie_name[:100], value=movie.movie_name[:100])
+            for movie in movies]
+
+
+# Define the /add command
+
+
+@bot.tree.command(name="add", description="Add a movie to the logger")
+@app_commands.describe(movie="Title of the movie",
+                       force="Add the movie even if a movie with a similar title is in the logger")
+async def slash_add(interaction, movie: str, force: bool = False):
+    # The movie is added right away and its details are filled in in the background
+    await interaction.response.send_message(queue_movie(movie.strip(), force=force))
+
 
-    # Send the sorted movie list to the channel
-    message = "\n".join(sorted_movies)
-    await ctx.send(message)
+# Define the /delete command
 
 
+@bot.tree.command(name="delete", description="Delete a movie from the logger")
+@app_commands.describe(movie="Title or UID of the movie")
+@app_commands.autocomplete(movie=movie_autocomplete)
+async def slash_delete(interaction, movie: str):
+    found = find_movie(movie)
+    delete_movie_status = delete_movie(movie)
+    if delete_movie_status:
+        await interaction.response.send_message(delete_movie_status)
+    else:
+        await interaction.response.send_message(f"Deleted movie: {found.movie_name}")
+
+
+# Define the /update command
+
+
+@bot.tree.command(name="update", description="Update a detail of a movie")
+@app_commands.describe(movie="Title or UID of the movie", field="Detail to update", value="New value")
+@app_commands.autocomplete(movie=movie_autocomplete)
+@app_commands.choices(field=[app_commands.Choice(name=field, value=field) for field in SEARCH_FIELDS])
+async def slash_update(interaction, movie: str, field: str, value: str):
+    await interaction.response.send_message(update_movie(movie, field, value))
+
+
+# Define the /search command
+
+
+@bot.tree.command(name="search", description="Search the movies in the logger")
+@app_commands.describe(query="Text to search for", field="Detail to search in (the title by default)")
+@app_commands.autocomplete(query=title_autocomplete)
+@app_commands.choices(field=[app_commands.Choice(name=field, value=field) for field in SEARCH_FIELDS])
+async def slash_search(interaction, query: str, field: str = "movie_name"):
+    search_results = search_movies(query, field)
+    if isinstance(search_results, list):
+        search_results = "Search results:\n" + "\n".join(search_results)
+    # Discord messages are limited to 2000 characters
+    if len(search_results) > MESSAGE_LIMIT:
+        search_results = search_results[:MESSAGE_LIMIT - 3] + "..."
+    await interaction.response.send_message(search_results)
+
+
+# Define the /list command
+
+
+@bot.tree.command(name="list", description="List the movies in the logger")
+@app_commands.describe(sort_by="Order of the list (the order the movies were added by default)")
+@app_commands.choices(sort_by=[app_commands.Choice(name=field, value=field) for field in SORT_FIELDS])
+async def slash_list(interaction, sort_by: str = "added"):
+    await MoviePages(sort_by).respond(interaction)
 
 
 # Handle command errors using the on_command_error event
@@ -460,9 +3179,26 @@ async def on_command_error(ctx, error):
     ignored = (commands.CommandNotFound, commands.UserInputError)
     if isinstance(error, ignored):
         return
+    # The catalog could not be loaded
+    if isinstance(error, CatalogUnavailable):
+        await ctx.send(str(error))
+        return
+    # The admin commands are refused to everyone else
+    if isinstance(error, commands.CheckFailure):
+        await ctx.send("You are not allowed to use this command.")
+        return
 
     # Log the error
     print(f"Error in command '{ctx.command}': {error}")
 
-# Run the using the bot token
-bot.run(os.getenv("DISCORD_BOT_TOKEN"))
+end_startup_phase("module setup")
+
+# Run the using the bot token (unless the file is imported, e.g. by the benchmarks).
+# python UncleMovies.py --import-imdb <directory> builds the IMDb index instead
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--import-imdb":
+        started = time.perf_counter()
+        count = import_imdb(sys.argv[2], movie_reference.path)
+        print(f"Imported {count} movies into {movie_reference.path} in {time.perf_counter() - started:.0f}s")
+    else:
+        bot.run(os.getenv("DISCORD_BOT_TOKEN"))
@@ -0,0 +1,66 @@
+# Micro-benchmark of parse_movie_completion on recorded OpenAI completions.
+# Run it from the root of the repository with: python benchmarks/parser_benchmark.py
+import os
+import re
+import sys
+import timeit
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from UncleMovies import parse_movie_completion  # noqa: E402
+
+# Completions recorded from text-davinci-003, for the old prompt and for the current one
+RECORDED_COMPLETIONS = [
+    "\n\nMovie Name: Inception\nYear: 2010\nDirector: Christopher Nolan\n"
+    "Description: A thief who steals corporate secrets through the use of dream-sharing technology is given "
+    "the inverse task of planting an idea into the mind of a C.E.O.\nGenre: Action, Adventure, Sci-Fi",
+    "\nMovie Name: The Godfather\nYear: 1972\nDirector: Francis Ford Coppola\n"
+    "Description: The aging patriarch of an organized crime dynasty transfers control of his clandestine "
+    "empire to his reluctant son.\nGenre: Crime, Drama",
+    "Movie Name: Spirited Away\nYear: 2001\nDirector: Hayao Miyazaki\n"
+    "Description: During her family's move to the suburbs, a sullen 10-year-old girl wanders into a world\n"
+    "ruled by gods, witches, and spirits, and where humans are changed into beasts.\nGenre: Animation, Adventure, Family",
+    "\n\nMovie Name: Alien\nYear: 1979\nDirector: Ridley Scott\nDescription: The crew of a commercial spacecraft "
+    "encounter a deadly lifeform after investigating an unknown transmission.\nGenre: Horror, Sci-Fi\n\n"
+    "Alien is widely considered one of the greatest science fiction films of all time.",
+    "I'm sorry, I could not find a movie with that title.",
+]
+
+
+# The parser before the single-pass one, for comparison
+def regex_parse_movie_completion(completion):
+    movie_name = re.search("Movie Name:(.*)", completion)
+    year = re.search("Year:(.*)", completion)
+    director = re.search("Director:(.*)", completion)
+    description = re.search("Description:(.*)", completion, re.DOTALL)
+    genre_list = re.search("Genre:(.*)", completion)
+    if None in (movie_name, year, director, description, genre_list):
+        return None
+    return {
+        "id": uuid.uuid4().hex,
+        "movie_name": movie_name.group(1).strip(),
+        "year": year.group(1).strip(),
+        "director": director.group(1).strip(),
+        "description": description.group(1).strip(),
+        "genre": genre_list.group(1).strip().split(", ")
+    }
+
+
+def benchmark(parse, completions, number=20000):
+    def run():
+        for completion in completions:
+            parse(completion)
+    seconds = min(timeit.repeat(run, number=number, repeat=5))
+    return seconds / (number * len(completions)) * 1e6
+
+
+if __name__ == "__main__":
+    for completion in RECORDED_COMPLETIONS:
+        movie = parse_movie_completion(completion)
+        print(movie and {field: value for field, value in movie.to_dict().items() if field != "id"})
+    # Answers that are read and answers that are rejected are timed apart, as they cost very differently
+    well_formed = [completion for completion in RECORDED_COMPLETIONS if parse_movie_completion(completion)]
+    rejected = [completion for completion in RECORDED_COMPLETIONS if completion not in well_formed]
+    for name, completions in (("well-formed", well_formed), ("rejected", rejected)):
+        print(f"{name} answers: single-pass parser {benchmark(parse_movie_completion, completions):.2f} us, "
+              f"regex parser {benchmark(regex_parse_movie_completion, completions):.2f} us per completion")
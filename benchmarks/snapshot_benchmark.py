@@ -0,0 +1,94 @@
+# Load-time and memory benchmark of the binary catalog snapshot (Movie records, with the descriptions
+# in memory or left on disk) against movies.json (plain dicts).
+# Run it from the root of the repository with: python benchmarks/snapshot_benchmark.py [number of movies]
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+GENRES = ["Action", "Adventure", "Animation", "Comedy", "Crime", "Drama", "Family", "Fantasy", "Horror",
+          "Mystery", "Romance", "Sci-Fi", "Thriller", "War", "Western"]
+WORDS = ["a", "the", "of", "young", "man", "woman", "family", "war", "love", "city", "secret", "journey",
+         "after", "must", "find", "their", "world", "past", "strange", "small", "town", "team", "lost"]
+
+
+# This function is used to make a catalog that looks like a real one: unique titles and
+# descriptions, and directors and genres shared between many movies
+
+
+def make_catalog(count, seed=1):
+    rng = random.Random(seed)
+    directors = [f"{rng.choice(WORDS).title()} Director {i}" for i in range(max(1, count // 20))]
+    movies = []
+    for i in range(count):
+        movies.append({
+            "id": "%032x" % rng.getrandbits(128),
+            "movie_name": " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))).title() + f" {i}",
+            "year": str(rng.randint(1920, 2023)),
+            "director": rng.choice(directors),
+            "description": " ".join(rng.choice(WORDS) for _ in range(rng.randint(15, 35))).capitalize() + ".",
+            "genre": rng.sample(GENRES, rng.randint(1, 3)),
+        })
+    return {"movies": movies, "seq": 0}
+
+
+# This function is used to get the resident memory of this process in bytes
+
+
+def resident_memory():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+# This function is used (in a child process, so each format starts from the same memory) to load
+# a snapshot and print the time it took and the memory the loaded catalog uses
+
+
+def measure(snapshot_format, path):
+    import UncleMovies
+    before = resident_memory()
+    started = time.perf_counter()
+    if snapshot_format == "json":
+        with open(path, "r") as json_file:
+            data = json.load(json_file)
+    else:
+        data = UncleMovies.read_binary_snapshot(path, lazy_descriptions=snapshot_format == "lazy")
+    seconds = time.perf_counter() - started
+    print(json.dumps({"seconds": seconds, "memory": resident_memory() - before, "movies": len(data["movies"])}))
+
+
+def main(count):
+    # Importing the bot opens its caches in the working directory
+    os.chdir(tempfile.mkdtemp())
+    import UncleMovies
+    data = make_catalog(count)
+    paths = {"json": os.path.abspath("movies.json"), "binary": os.path.abspath("movies.snapshot")}
+    started = time.perf_counter()
+    with open(paths["json"], "w") as json_file:
+        json.dump(data, json_file)
+    write_seconds = {"json": time.perf_counter() - started}
+    started = time.perf_counter()
+    UncleMovies.write_binary_snapshot(paths["binary"], data)
+    write_seconds["binary"] = write_seconds["lazy"] = time.perf_counter() - started
+    paths["lazy"] = paths["binary"]
+
+    print(f"{count} movies")
+    print(f"{'format':<8}{'size MB':>10}{'write s':>10}{'load s':>10}{'RSS MB':>10}")
+    for snapshot_format, path in paths.items():
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--measure", snapshot_format, path],
+                                capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{snapshot_format:<8}{os.path.getsize(path) / 1e6:>10.1f}{write_seconds[snapshot_format]:>10.2f}"
+              f"{result['seconds']:>10.2f}{result['memory'] / 1e6:>10.1f}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--measure":
+        measure(sys.argv[2], sys.argv[3])
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,74 @@
+# Tests of parse_movie_completion on well-formed and malformed OpenAI completions.
+# Run them from the root of the repository with: python -m pytest tests
+import os
+import sys
+
+import pytest
+
+# UncleMovies sets up the bot when it is imported, so the tests need its dependencies
+for module in ("discord", "dotenv", "aiohttp", "openai"):
+    pytest.importorskip(module)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import UncleMovies  # noqa: E402
+
+ALIEN = ("Movie Name: Alien\nYear: 1979\nDirector: Ridley Scott\n"
+         "Description: The crew of a commercial spacecraft encounter a deadly lifeform.\nGenre: Horror, Sci-Fi")
+
+
+def details(completion):
+    movie = UncleMovies.parse_movie_completion(completion)
+    return movie and {field: value for field, value in movie.to_dict().items() if field != "id"}
+
+
+def test_well_formed():
+    assert details(ALIEN) == {"movie_name": "Alien", "year": "1979", "director": "Ridley Scott",
+                              "description": "The crew of a commercial spacecraft encounter a deadly lifeform.",
+                              "genre": ["Horror", "Sci-Fi"]}
+
+
+def test_text_around_the_answer():
+    # Blank lines before the answer, indented lines, Windows line ends and a remark after the
+    # Genre line are all left out
+    completion = "\n\n  " + ALIEN.replace("\n", "\r\n  ") + "\r\n\nAlien is one of the greatest science fiction films."
+    assert details(completion) == details(ALIEN)
+
+
+def test_multi_line_description():
+    completion = ALIEN.replace("a deadly lifeform.", "a deadly lifeform\nafter investigating a transmission.")
+    movie = details(completion)
+    assert movie["description"] == ("The crew of a commercial spacecraft encounter a deadly lifeform "
+                                    "after investigating a transmission.")
+    # The description stops at the Genre line instead of taking it in
+    assert movie["genre"] == ["Horror", "Sci-Fi"]
+
+
+def test_genres():
+    assert details(ALIEN.replace("Horror, Sci-Fi", " Horror ,Sci-Fi, ,"))["genre"] == ["Horror", "Sci-Fi"]
+    assert details(ALIEN.replace("Horror, Sci-Fi", ""))["genre"] == []
+
+
+@pytest.mark.parametrize("line", ["Movie Name", "Year", "Director", "Description", "Genre"])
+def test_missing_line(line):
+    lines = [text for text in ALIEN.split("\n") if not text.startswith(line + ":")]
+    assert UncleMovies.parse_movie_completion("\n".join(lines)) is None
+
+
+def test_reordered_lines():
+    lines = ALIEN.split("\n")
+    lines[1], lines[2] = lines[2], lines[1]
+    assert UncleMovies.parse_movie_completion("\n".join(lines)) is None
+
+
+def test_empty_title():
+    assert UncleMovies.parse_movie_completion(ALIEN.replace("Alien", " ")) is None
+
+
+@pytest.mark.parametrize("completion", [
+    "I'm sorry, I could not find a movie with that title.",
+    "As an AI language model, I cannot provide details about this movie.\nGenre: unknown",
+    "",
+])
+def test_refusal(completion):
+    assert UncleMovies.parse_movie_completion(completion) is None
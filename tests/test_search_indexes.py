@@ -0,0 +1,248 @@
+# Randomized tests of the search structures against the naive versions they replace: edit_distance
+# against the dynamic-programming Levenshtein distance, TitleTree against comparing every title,
+# and the token and trigram indexes (and MovieStore.search) against checking every movie with `in`.
+# Run them from the root of the repository with: python -m pytest tests
+import asyncio
+import os
+import random
+import sys
+
+import pytest
+
+# UncleMovies sets up the bot when it is imported, so the tests need its dependencies
+for module in ("discord", "dotenv", "aiohttp", "openai"):
+    pytest.importorskip(module)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import UncleMovies  # noqa: E402
+
+# Few letters and short words, so random titles and queries share a lot of text
+ALPHABET = "abcdé"
+WORDS = ["ab", "ba", "abc", "cab", "dab", "bad", "déé", "aaa", "ii", "x", "Abc", "CAB"]
+GENRES = ["Drama", "Action", "Sci-Fi", "Film-Noir"]
+
+
+def levenshtein(a, b):
+    row = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        previous, row[0] = row[0], i
+        for j, char_b in enumerate(b, 1):
+            previous, row[j] = row[j], min(row[j] + 1, row[j - 1] + 1, previous + (char_a != char_b))
+    return row[-1]
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def random_text(rng, max_words):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, max_words)))
+
+
+def random_movie(rng, number):
+    return UncleMovies.Movie(f"{number:032x}", random_text(rng, 3), str(rng.randint(1990, 1999)),
+                             random_text(rng, 2), random_text(rng, 8), rng.sample(GENRES, rng.randint(0, 2)))
+
+
+# This function is used to get random queries: pieces of the indexed text (cut anywhere, so they
+# start and end in the middle of words) and some random strings
+
+
+def random_queries(rng, movies, count):
+    queries = []
+    for _ in range(count):
+        if rng.random() < 0.2:
+            queries.append("".join(rng.choice(ALPHABET + " ") for _ in range(rng.randint(1, 5))))
+            continue
+        movie = rng.choice(movies)
+        text = UncleMovies.fold(rng.choice([movie.movie_name, movie.director, movie.description]))
+        start = rng.randint(0, len(text) - 1)
+        queries.append(text[start:start + rng.randint(1, 10)])
+    return queries
+
+
+# This function is used to check the movies the naive way: does the folded field contain the query
+
+
+def matches(movie, field, query):
+    if field == "genre":
+        return any(query in UncleMovies.fold(genre) for genre in movie.genre)
+    return query in UncleMovies.fold(getattr(movie, field))
+
+
+# This function is used to change the movies at random (adding, renaming, changing fields and
+# removing them) through callbacks, and to keep the list of the movies that are left
+
+
+def random_changes(rng, movies, count, add, update, discard):
+    for _ in range(count):
+        action = rng.random()
+        if action < 0.4 or not movies:
+            movie = random_movie(rng, rng.getrandbits(64))
+            movies.append(movie)
+            add(movie)
+        elif action < 0.7:
+            movie = rng.choice(movies)
+            field = rng.choice(["movie_name", "director", "description", "genre"])
+            update(movie, field, rng.sample(GENRES, 2) if field == "genre" else random_text(rng, 4))
+        else:
+            movie = movies.pop(rng.randrange(len(movies)))
+            discard(movie)
+
+
+def test_edit_distance():
+    rng = random.Random(1)
+    for _ in range(3000):
+        a = "".join(rng.choice(ALPHABET) for _ in range(rng.randint(0, 12)))
+        b = "".join(rng.choice(ALPHABET) for _ in range(rng.randint(0, 12)))
+        assert UncleMovies.edit_distance(a, b) == levenshtein(a, b), (a, b)
+
+
+def test_edit_distance_of_long_strings():
+    # Strings longer than a machine word need more than 64 bits per column
+    rng = random.Random(2)
+    for _ in range(100):
+        a = "".join(rng.choice("ab") for _ in range(rng.randint(60, 140)))
+        b = "".join(rng.choice("ab") for _ in range(rng.randint(60, 140)))
+        assert UncleMovies.edit_distance(a, b) == levenshtein(a, b)
+
+
+def test_title_tree():
+    rng = random.Random(3)
+    tree = UncleMovies.TitleTree()
+    movies = [random_movie(rng, number) for number in range(300)]
+    tree.build(movies)
+
+    def rename(movie, field, value):
+        if field == "movie_name":
+            tree.discard(movie)
+            movie.movie_name = value
+            tree.add(movie)
+
+    # Enough removals to rebuild the tree on the way
+    for _ in range(10):
+        random_changes(rng, movies, 60, tree.add, rename, tree.discard)
+        for _ in range(20):
+            title = random_text(rng, 3)
+            max_distance = rng.randint(0, 3)
+            expected = {movie.id: levenshtein(UncleMovies.normalize_title(title),
+                                              UncleMovies.normalize_title(movie.movie_name))
+                        for movie in movies}
+            similar = tree.similar(title, max_distance)
+            assert sorted(movie.id for movie in similar) == sorted(
+                movie_id for movie_id, distance in expected.items() if distance <= max_distance)
+            # Closest first
+            distances = [expected[movie.id] for movie in similar]
+            assert distances == sorted(distances)
+
+
+def test_token_index():
+    rng = random.Random(4)
+    fields = ["movie_name", "director", "description", "genre"]
+    index = UncleMovies.TokenIndex(fields)
+    movies = [random_movie(rng, number) for number in range(200)]
+    index.build(movies)
+
+    def update(movie, field, value):
+        index.discard(movie)
+        setattr(movie, field, value)
+        index.add(movie)
+
+    for _ in range(5):
+        random_changes(rng, movies, 50, index.add, update, index.discard)
+        for query in random_queries(rng, movies, 200):
+            for field in fields:
+                candidates = index.candidates(field, query)
+                if candidates is None:
+                    continue
+                # Every movie that contains the query is a candidate
+                expected = {movie.id for movie in movies if matches(movie, field, query)}
+                assert expected <= candidates, (field, query)
+                assert candidates <= {movie.id for movie in movies}
+
+
+def test_trigram_index():
+    rng = random.Random(5)
+    fields = ["movie_name", "director", "description"]
+    index = UncleMovies.TrigramIndex(fields)
+    movies = [random_movie(rng, number) for number in range(200)]
+    index.build(movies)
+
+    def update(movie, field, value):
+        index.discard(movie)
+        setattr(movie, field, value)
+        index.add(movie)
+
+    # Enough removals to leave stale numbers in the postings and to rebuild the index on the way
+    for _ in range(5):
+        random_changes(rng, movies, 600, index.add, update, index.discard)
+        for query in random_queries(rng, movies, 200):
+            for field in fields:
+                candidates = index.candidates(field, query)
+                if candidates is None:
+                    assert len(query) < 3
+                    continue
+                # Exactly the movies that have every trigram of the query, which includes every movie
+                # that contains it
+                assert candidates == {movie.id for movie in movies
+                                      if trigrams(query) <= trigrams(UncleMovies.fold(getattr(movie, field)))}
+                assert {movie.id for movie in movies if matches(movie, field, query)} <= candidates, (field, query)
+
+
+def test_trigram_index_max_candidates():
+    movies = [UncleMovies.Movie(f"{number:032x}", "the movie" if number % 10 else "rare title")
+              for number in range(100)]
+    index = UncleMovies.TrigramIndex(["movie_name"])
+    index.build(movies)
+    # Checking every movie is faster than looking up a trigram that most movies have
+    assert index.candidates("movie_name", "movie", max_candidates=25) is None
+    assert index.candidates("movie_name", "movie") == {movie.id for movie in movies if movie.movie_name == "the movie"}
+    assert len(index.candidates("movie_name", "rare", max_candidates=25)) == 10
+    assert index.candidates("movie_name", "zzz", max_candidates=25) == set()
+
+
+def test_store_search(tmp_path):
+    rng = random.Random(6)
+    store = UncleMovies.MovieStore(str(tmp_path / "movies.json"), snapshot_path=None)
+    movies = [random_movie(rng, number) for number in range(200)]
+    store.add_many(list(movies))
+
+    for _ in range(5):
+        random_changes(rng, movies, 50, store.add, store.update, store.delete)
+        catalog = store.all()
+        for query in random_queries(rng, movies, 100):
+            for field in ["movie_name", "year", "director", "description", "genre"]:
+                expected = [movie.id for movie in catalog if matches(movie, field, query)]
+                assert [movie.id for movie in store.search(query, field)] == expected, (field, query)
+    store.flush()
+
+
+def test_deferred_build(tmp_path):
+    rng = random.Random(7)
+    movies = [random_movie(rng, number) for number in range(300)]
+    saved = UncleMovies.MovieStore(str(tmp_path / "movies.json"), snapshot_path=None)
+    saved.add_many(movies)
+    saved.flush()
+    store = UncleMovies.MovieStore(str(tmp_path / "movies.json"), snapshot_path=None, defer_indexes=True)
+    movies = store.all()
+
+    async def build_while_changing():
+        build = asyncio.ensure_future(store.build_indexes(slice_seconds=0.001))
+        while not build.done():
+            random_changes(rng, movies, 2, store.add, store.update, store.delete)
+            await asyncio.sleep(0)
+        await build
+
+    # Searches check every movie until the indexes are built, and use them afterwards
+    asyncio.run(build_while_changing())
+    assert not store.defer_indexes
+    catalog = store.all()
+    for query in random_queries(rng, movies, 200):
+        for field in ["movie_name", "director", "description", "genre"]:
+            expected = [movie.id for movie in catalog if matches(movie, field, query)]
+            assert [movie.id for movie in store.search(query, field)] == expected, (field, query)
+        title = random_text(rng, 3)
+        assert sorted(movie.id for movie in store.similar_titles(title, 1)) == sorted(
+            movie.id for movie in UncleMovies.similar_by_scan(catalog, title, 1))
+    store.flush()
@@ -0,0 +1,208 @@
+# Round-trip tests of the binary catalog snapshot and the journal of JournalMovieStore.
+# Run them from the root of the repository with: python -m pytest tests
+import json
+import os
+import struct
+import sys
+
+import pytest
+
+# UncleMovies sets up the bot when it is imported, so the tests need its dependencies
+for module in ("discord", "dotenv", "aiohttp", "openai"):
+    pytest.importorskip(module)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import UncleMovies  # noqa: E402
+
+
+# This function is used to make a small catalog with the strings the snapshot has to get right:
+# shared directors and genres, non-ASCII text, NUL characters, empty fields and no genres
+
+
+def make_catalog():
+    movies = [
+        {"id": "a" * 32, "movie_name": "Heat", "year": "1995", "director": "Michael Mann",
+         "description": "A group of robbers...", "genre": ["Action", "Crime"]},
+        {"id": "b" * 32, "movie_name": "Thief", "year": "1981", "director": "Michael Mann",
+         "description": "A safecracker\x00takes one last job.", "genre": ["Crime"]},
+        {"id": "c" * 32, "movie_name": "Amélie\x00", "year": "2001", "director": "Jean-Pierre Jeunet",
+         "description": "Une jeune serveuse à Montmartre — 東京", "genre": []},
+        {"id": "d" * 32, "movie_name": "Untitled", "year": "", "director": "",
+         "description": "", "genre": ["Drama", "Action"]},
+    ]
+    return {"movies": movies, "seq": 7}
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / "movies.snapshot")
+    catalog = make_catalog()
+    UncleMovies.write_binary_snapshot(path, catalog)
+
+    data = UncleMovies.read_binary_snapshot(path)
+    assert data["seq"] == 7
+    assert [movie.to_dict() for movie in data["movies"]] == catalog["movies"]
+    assert not os.path.exists(f"{path}.tmp")
+
+
+def test_snapshot_header(tmp_path):
+    path = str(tmp_path / "movies.snapshot")
+    UncleMovies.write_binary_snapshot(path, make_catalog())
+
+    with open(path, "rb") as snapshot_file:
+        data = snapshot_file.read()
+    magic, version, count, seq, checksum, size = UncleMovies.SNAPSHOT_HEADER.unpack_from(data)
+    assert magic == UncleMovies.SNAPSHOT_MAGIC
+    assert version == UncleMovies.SNAPSHOT_VERSION
+    assert (count, seq) == (4, 7)
+    assert size == len(data) - UncleMovies.SNAPSHOT_HEADER.size
+
+
+def test_empty_snapshot(tmp_path):
+    path = str(tmp_path / "movies.snapshot")
+    UncleMovies.write_binary_snapshot(path, {"movies": []})
+
+    for lazy_descriptions in (False, True):
+        assert UncleMovies.read_binary_snapshot(path, lazy_descriptions) == {"movies": [], "seq": 0}
+
+
+def test_lazy_descriptions(tmp_path):
+    path = str(tmp_path / "movies.snapshot")
+    catalog = make_catalog()
+    UncleMovies.write_binary_snapshot(path, catalog)
+
+    movies = UncleMovies.read_binary_snapshot(path, lazy_descriptions=True)["movies"]
+    # The descriptions are read from the mapped file, and keep working after it is replaced
+    assert all(isinstance(movie._snapshot, UncleMovies.SnapshotText) for movie in movies)
+    UncleMovies.write_binary_snapshot(path, {"movies": []})
+    assert [movie.to_dict() for movie in movies] == catalog["movies"]
+
+    # A new description replaces the one in the file
+    movies[1].description = "Changed"
+    assert movies[1]._snapshot is None
+    assert movies[1].description == "Changed"
+
+
+@pytest.mark.parametrize("lazy_descriptions", [False, True])
+def test_damaged_snapshot(tmp_path, lazy_descriptions):
+    path = str(tmp_path / "movies.snapshot")
+    UncleMovies.write_binary_snapshot(path, make_catalog())
+    with open(path, "rb") as snapshot_file:
+        data = snapshot_file.read()
+
+    # A changed byte, a truncated payload or header, and a file that is not a snapshot are all refused
+    flipped = bytearray(data)
+    flipped[-10] ^= 0xFF
+    for damaged, message in ((bytes(flipped), "checksum mismatch"), (data[:-1], "checksum mismatch"),
+                             (data[:10], "truncated header"), (b"{}" * 32, "not a movie snapshot")):
+        with open(path, "wb") as snapshot_file:
+            snapshot_file.write(damaged)
+        with pytest.raises(ValueError, match=message):
+            UncleMovies.read_binary_snapshot(path, lazy_descriptions)
+
+
+def test_snapshot_version_mismatch(tmp_path):
+    path = str(tmp_path / "movies.snapshot")
+    UncleMovies.write_binary_snapshot(path, make_catalog())
+    with open(path, "r+b") as snapshot_file:
+        snapshot_file.seek(len(UncleMovies.SNAPSHOT_MAGIC))
+        snapshot_file.write(struct.pack("<H", UncleMovies.SNAPSHOT_VERSION - 1))
+
+    with pytest.raises(ValueError, match="unsupported snapshot version"):
+        UncleMovies.read_binary_snapshot(path)
+
+
+def test_store_ignores_damaged_snapshot(tmp_path):
+    json_path = str(tmp_path / "movies.json")
+    snapshot_path = str(tmp_path / "movies.snapshot")
+    catalog = make_catalog()
+    with open(json_path, "w") as json_file:
+        json.dump(catalog, json_file)
+    with open(snapshot_path, "wb") as snapshot_file:
+        snapshot_file.write(b"damaged")
+
+    store = UncleMovies.MovieStore(json_path, snapshot_path=snapshot_path)
+    assert [movie.to_dict() for movie in store.all()] == catalog["movies"]
+
+
+# This function is used to open a journal store with its files in a test directory
+
+
+def open_journal_store(directory, compact_size=1024 * 1024):
+    return UncleMovies.JournalMovieStore(str(directory / "movies.json"), str(directory / "movies.journal.jsonl"),
+                                         compact_size=compact_size, snapshot_path=str(directory / "movies.snapshot"))
+
+
+def test_journal_replay(tmp_path):
+    movies = [UncleMovies.Movie.from_dict(movie) for movie in make_catalog()["movies"]]
+    store = open_journal_store(tmp_path)
+    store.add(movies[0])
+    store.add_many(movies[1:])
+    store.update(store.get(movies[0].id), "genre", ["Thriller"])
+    store.update(store.get(movies[2].id), "description", "Changed\x00again")
+    store.delete(store.get(movies[3].id))
+    store.flush()
+    expected = [movie.to_dict() for movie in store.all()]
+
+    replayed = open_journal_store(tmp_path)
+    assert [movie.to_dict() for movie in replayed.all()] == expected
+    assert replayed.find_by_name("heat").genre == ["Thriller"]
+    assert replayed.get(movies[3].id) is None
+
+
+def test_journal_replay_skips_damaged_record(tmp_path):
+    movie = UncleMovies.Movie.from_dict(make_catalog()["movies"][0])
+    store = open_journal_store(tmp_path)
+    store.add(movie)
+    store.flush()
+    # A crash in the middle of an append leaves part of a record
+    with open(tmp_path / "movies.journal.jsonl", "a") as journal_file:
+        journal_file.write('{"op": "delete", "id": ')
+
+    replayed = open_journal_store(tmp_path)
+    assert [movie.id for movie in replayed.all()] == [movie.id]
+    # The next record starts on its own line, so it is replayed as well
+    replayed.update(replayed.get(movie.id), "year", "1996")
+    replayed.flush()
+    assert open_journal_store(tmp_path).get(movie.id).year == "1996"
+
+
+def test_journal_replay_after_compaction(tmp_path):
+    movies = [UncleMovies.Movie.from_dict(movie) for movie in make_catalog()["movies"]]
+    store = open_journal_store(tmp_path)
+    store.add_many(movies[:2])
+    store.compact()
+    # Written after the snapshot, so only these records are replayed on top of it
+    store.add(movies[2])
+    store.update(store.get(movies[0].id), "movie_name", "Heat (1995)")
+    store.flush()
+
+    assert UncleMovies.read_binary_snapshot(str(tmp_path / "movies.snapshot"))["seq"] == 1
+    replayed = open_journal_store(tmp_path)
+    assert [movie.to_dict() for movie in replayed.all()] == [movie.to_dict() for movie in store.all()]
+    assert replayed.find_by_name("Heat (1995)").id == movies[0].id
+
+
+def test_failed_compactions_keep_the_journal(tmp_path, monkeypatch):
+    movies = [UncleMovies.Movie.from_dict(movie) for movie in make_catalog()["movies"]]
+    store = open_journal_store(tmp_path)
+    write_snapshot = store._write_snapshot
+
+    def fail(data):
+        raise OSError("disk full")
+
+    # Two compactions in a row cannot write the snapshot
+    monkeypatch.setattr(store, "_write_snapshot", fail)
+    for movie in movies[:2]:
+        store.add(movie)
+        with pytest.raises(OSError):
+            store.compact()
+    store.flush()
+    assert [movie.id for movie in open_journal_store(tmp_path).all()] == [movie.id for movie in movies[:2]]
+
+    # The next one folds every record into the snapshot
+    monkeypatch.setattr(store, "_write_snapshot", write_snapshot)
+    store.add(movies[2])
+    store.compact()
+    assert not os.path.exists(tmp_path / "movies.journal.jsonl.compacting")
+    assert [movie.id for movie in open_journal_store(tmp_path).all()] == [movie.id for movie in movies[:3]]
@@ -0,0 +1,54 @@
+# Tests of SQLiteMovieStore: copying movies.json into a new database, and the searches.
+# Run them from the root of the repository with: python -m pytest tests
+import json
+import os
+import sys
+
+import pytest
+
+# UncleMovies sets up the bot when it is imported, so the tests need its dependencies
+for module in ("discord", "dotenv", "aiohttp", "openai"):
+    pytest.importorskip(module)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import UncleMovies  # noqa: E402
+
+MOVIES = [
+    {"id": "a" * 32, "movie_name": "Heat", "year": "1995", "director": "Michael Mann",
+     "description": "A group of robbers...", "genre": ["Action", "Crime"]},
+    {"id": "b" * 32, "movie_name": "Thief", "year": "1981", "director": "Michael Mann",
+     "description": "A safecracker takes one last job.", "genre": ["Crime"]},
+]
+
+
+def write_json(path, movies):
+    with open(path, "w") as json_file:
+        json.dump({"movies": movies}, json_file)
+
+
+def test_migration_is_tried_again_after_a_failure(tmp_path):
+    db_path = str(tmp_path / "movies.db")
+    json_path = str(tmp_path / "movies.json")
+    # A record without an ID stops the copy, and leaves an empty database file behind
+    write_json(json_path, MOVIES + [{"movie_name": "Broken"}])
+    with pytest.raises(KeyError):
+        UncleMovies.SQLiteMovieStore(db_path, json_path)
+    assert os.path.exists(db_path)
+
+    write_json(json_path, MOVIES)
+    store = UncleMovies.SQLiteMovieStore(db_path, json_path)
+    assert [movie.to_dict() for movie in store.all()] == MOVIES
+
+
+def test_migration_runs_once(tmp_path):
+    db_path = str(tmp_path / "movies.db")
+    json_path = str(tmp_path / "movies.json")
+    write_json(json_path, MOVIES)
+    store = UncleMovies.SQLiteMovieStore(db_path, json_path)
+    for movie in store.all():
+        store.delete(movie)
+    store.conn.close()
+
+    # A catalog that was emptied on purpose is not filled from movies.json again
+    assert UncleMovies.SQLiteMovieStore(db_path, json_path).count() == 0
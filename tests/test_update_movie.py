@@ -0,0 +1,46 @@
+# Tests of update_movie_fields, which >update uses to change several fields of a movie at once.
+# Run them from the root of the repository with: python -m pytest tests
+import os
+import sys
+
+import pytest
+
+# UncleMovies sets up the bot when it is imported, so the tests need its dependencies
+for module in ("discord", "dotenv", "aiohttp", "openai"):
+    pytest.importorskip(module)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import UncleMovies  # noqa: E402
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def store(request, tmp_path, monkeypatch):
+    if request.param == "sqlite":
+        store = UncleMovies.SQLiteMovieStore(str(tmp_path / "movies.db"), str(tmp_path / "movies.json"))
+    else:
+        store = UncleMovies.MovieStore(str(tmp_path / "movies.json"), snapshot_path=None)
+    store.add(UncleMovies.Movie("a" * 32, "Alien", "1979", "Ridley Scott", "In space...", ["Horror"]))
+    monkeypatch.setattr(UncleMovies, "store", store)
+    yield store
+    store.flush()
+
+
+def test_rename_and_other_fields(store):
+    result = UncleMovies.update_movie_fields("alien", {"movie_name": "Aliens", "year": "1986",
+                                                       "genre": "Action, Sci-Fi"})
+    assert result == "Movie updated successfully"
+    movie = store.get("a" * 32)
+    assert (movie.movie_name, movie.year, movie.genre) == ("Aliens", "1986", ["Action", "Sci-Fi"])
+    assert store.find_by_name("Alien") is None
+
+
+def test_invalid_field_changes_nothing(store):
+    result = UncleMovies.update_movie_fields("Alien", {"year": "1986", "budget": "11M"})
+    assert result.startswith("Invalid field")
+    assert store.get("a" * 32).year == "1979"
+
+
+def test_movie_not_found(store):
+    assert UncleMovies.update_movie_fields("Predator", {"year": "1987"}) == "Movie not found"
+    assert UncleMovies.update_movie("Alien", "director", "Scott") == "director of movie 'Alien' is updated to 'Scott'"